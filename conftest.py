@@ -0,0 +1,29 @@
+import random
+import struct
+from typing import Callable, List
+
+import pytest
+
+# Empty, ASCII, and 2, 3 and 4 byte UTF-8 slots
+sample_texts = ['', 'Hello, world!', 'Ça coûte 5 €, señor', 'Жизнь прекрасна', 'こんにちは', '漢字テスト', '🙂 emoji 🚀', '',
+                'line\nbreak\ttab', '']
+
+
+@pytest.fixture
+def text_records() -> Callable[[int, int, int], List[bytes]]:
+    # Builds raw LocalizedTextResource records: header, uuid, then per language a u16 size, the UTF-8 text and
+    # unk_size trailing bytes (3 in Death Stranding, none in Horizon Zero Dawn). Between them, the records put every
+    # sample text in every language slot.
+    def make_one(type_hash: int, languages: int, unk_size: int, seed: int) -> bytes:
+        rng = random.Random(seed)
+        body = bytearray(rng.getrandbits(128).to_bytes(16, 'little'))
+        for lang in range(languages):
+            val = sample_texts[(seed + lang) % len(sample_texts)].encode('utf8')
+            body += struct.pack('<H', len(val))
+            body += val
+            body += rng.getrandbits(8 * unk_size).to_bytes(unk_size, 'little')
+        return struct.pack('<QI', type_hash, len(body)) + bytes(body)
+
+    def make(type_hash: int, languages: int, unk_size: int) -> List[bytes]:
+        return [make_one(type_hash, languages, unk_size, seed) for seed in range(len(sample_texts))]
+    return make
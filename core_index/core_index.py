@@ -0,0 +1,210 @@
+import os
+import sys
+import mmap
+import struct
+import sqlite3
+import argparse
+import binascii
+from pathlib import PurePath
+from typing import NamedTuple, Optional, Iterator, List, Tuple
+
+object_header_struct = struct.Struct('<QI')
+schema = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS objects (
+    uuid BLOB NOT NULL,
+    file_id INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+    type_hash INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS objects_uuid ON objects (uuid);
+CREATE INDEX IF NOT EXISTS objects_file ON objects (file_id);
+'''
+
+
+class IndexEntry(NamedTuple):
+    uuid: bytes
+    path: str  # Relative to the game root, with forward slashes
+    type_hash: int
+    offset: int
+    size: int  # Size from the object header, i.e. not counting the 12-byte type hash and size prefix
+
+
+def to_signed(type_hash: int) -> int:
+    # SQLite integers are signed 64-bit, type hashes are unsigned
+    return type_hash - (1 << 64) if type_hash >= (1 << 63) else type_hash
+
+
+def to_unsigned(type_hash: int) -> int:
+    return type_hash + (1 << 64) if type_hash < 0 else type_hash
+
+
+def scan_headers(path: str) -> Iterator[Tuple[bytes, int, int, int]]:
+    # Same header walk as read_objects_from_stream, without parsing anything: yields (uuid, type_hash, offset, size)
+    with open(path, 'rb') as in_file:
+        if os.fstat(in_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            pos = 0
+            while pos < len(view):
+                if pos + 28 > len(view):
+                    raise Exception('Truncated object header at offset {}'.format(pos))
+                type_hash, size = object_header_struct.unpack_from(view, pos)
+                if pos + 12 + size > len(view):
+                    raise Exception('Object at offset {} runs past end of file'.format(pos))
+                yield view[pos + 12:pos + 28], type_hash, pos, size
+                pos += 12 + size
+
+
+class CoreIndex:
+    # On-disk UUID -> (core file, type hash, offset, size) index for every object under a game root. Lookups go through
+    # an SQLite B-tree index, and read_record seeks straight to the object, so no core has to be parsed to find it.
+    def __init__(self, db_path: str, game_root: Optional[str] = None):
+        self.db = sqlite3.connect(db_path)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(schema)
+        if game_root is not None:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('game_root', ?)", (os.path.abspath(game_root),))
+            self.db.commit()
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'game_root'").fetchone()
+        if row is None:
+            raise ValueError('{} has no game root; pass one to build a new index'.format(db_path))
+        self.game_root: str = row[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def update(self, verbose=False, batch_size=256) -> Tuple[int, int, List[str]]:
+        # Rescans only cores that are new or whose mtime/size changed, and drops cores that no longer exist. A core that
+        # can't be scanned is reported and left out of the index rather than aborting the update, and progress is
+        # committed every batch_size cores. Returns (cores scanned, cores removed, cores that failed).
+        known = {path: (file_id, mtime_ns, size)
+                 for file_id, path, mtime_ns, size in self.db.execute('SELECT id, path, mtime_ns, size FROM files')}
+        seen = set()
+        scanned = 0
+        failed = []
+        for root, _, files in os.walk(self.game_root):
+            for file in files:
+                if not file.endswith('.core'):
+                    continue
+                full_path = os.path.join(root, file)
+                rel_path = PurePath(os.path.relpath(full_path, self.game_root)).as_posix()
+                seen.add(rel_path)
+                stat = os.stat(full_path)
+                entry = known.get(rel_path)
+                if entry is not None and entry[1:] == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                if verbose:
+                    print(rel_path)
+                try:
+                    self.index_file(full_path, rel_path, stat)
+                except Exception as e:
+                    # Whatever was indexed for it before is stale now
+                    self.db.execute('DELETE FROM files WHERE path = ?', (rel_path,))
+                    failed.append(rel_path)
+                    print(e)
+                    continue
+                scanned += 1
+                if scanned % batch_size == 0:
+                    self.db.commit()
+        removed = [(known[path][0],) for path in known if path not in seen]
+        self.db.executemany('DELETE FROM files WHERE id = ?', removed)
+        self.db.commit()
+        return scanned, len(removed), failed
+
+    def index_file(self, full_path: str, rel_path: str, stat: os.stat_result):
+        # The whole core is scanned before anything is written, so a malformed one leaves no partial rows behind
+        try:
+            objects = [(bytes(uuid), to_signed(type_hash), offset, size)
+                       for uuid, type_hash, offset, size in scan_headers(full_path)]
+        except Exception as e:
+            raise Exception(f'Error in {full_path}: {e}')
+        self.db.execute('DELETE FROM files WHERE path = ?', (rel_path,))
+        file_id = self.db.execute('INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)',
+                                  (rel_path, stat.st_mtime_ns, stat.st_size)).lastrowid
+        self.db.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?)',
+                            ((uuid, file_id, type_hash, offset, size) for uuid, type_hash, offset, size in objects))
+
+    def lookup_all(self, uuid: bytes) -> Iterator[IndexEntry]:
+        for path, type_hash, offset, size in self.db.execute(
+                'SELECT files.path, objects.type_hash, objects.offset, objects.size FROM objects '
+                'JOIN files ON files.id = objects.file_id WHERE objects.uuid = ? ORDER BY files.path', (uuid,)):
+            yield IndexEntry(uuid, path, to_unsigned(type_hash), offset, size)
+
+    def lookup(self, uuid: bytes) -> Optional[IndexEntry]:
+        return next(self.lookup_all(uuid), None)
+
+    def full_path(self, entry: IndexEntry) -> str:
+        return os.path.join(self.game_root, entry.path)
+
+    def read_record(self, uuid: bytes) -> Optional[bytes]:
+        # Raw bytes of the object (header included), ready for read_objects_from_stream(io.BytesIO(...), ...).
+        # Entries whose core changed since it was indexed, or whose bytes no longer hold this object, are skipped, so a
+        # stale index returns None rather than some other object's bytes.
+        for path, type_hash, offset, size, mtime_ns, file_size in self.db.execute(
+                'SELECT files.path, objects.type_hash, objects.offset, objects.size, files.mtime_ns, files.size '
+                'FROM objects JOIN files ON files.id = objects.file_id WHERE objects.uuid = ? ORDER BY files.path',
+                (uuid,)):
+            full_path = os.path.join(self.game_root, path)
+            try:
+                with open(full_path, 'rb') as core_file:
+                    stat = os.fstat(core_file.fileno())
+                    if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, file_size):
+                        continue
+                    core_file.seek(offset)
+                    record = core_file.read(size + 12)
+            except FileNotFoundError:
+                continue
+            if len(record) == size + 12 and record[12:28] == uuid and \
+                    object_header_struct.unpack_from(record) == (to_unsigned(type_hash), size):
+                return record
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--index', type=str, default=os.path.join(os.path.dirname(__file__), 'core_index.db'),
+                        help="Path to the index database (defaults to core_index.db beside this script).")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-b', '--build', action='store_true',
+                       help="Build or update the index for the game root in hzd_root_path.txt.")
+    group.add_argument('-l', '--lookup', type=str, nargs='+',
+                       help="UUIDs (as hex) to look up in the index.")
+    args = parser.parse_args()
+
+    if args.build:
+        game_root_file = os.path.join(os.path.dirname(__file__), r'hzd_root_path.txt')
+        game_root = open(game_root_file, 'r').read().strip('" \t\r\n')
+        assert os.path.isdir(game_root), "hzd_root_path.txt does not contain a path to a valid directory"
+        with CoreIndex(args.index, game_root) as index:
+            scanned, removed, failed = index.update(verbose=True)
+        print(f'Index updated: {scanned} cores scanned, {removed} removed, {len(failed)} failed.')
+        if failed:
+            print('Failed cores (not indexed):')
+            for rel_path in sorted(failed):
+                print(f'  {rel_path}')
+            sys.exit(1)
+    elif args.lookup:
+        with CoreIndex(args.index) as index:
+            for uuid_hex in args.lookup:
+                entries = list(index.lookup_all(binascii.unhexlify(uuid_hex)))
+                if not entries:
+                    print(f'{uuid_hex}: not found')
+                for entry in entries:
+                    print(f'{uuid_hex}: {entry.path} @ {entry.offset}, {entry.size + 12} bytes, '
+                          f'type {entry.type_hash:X}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+import ds_decima as decima
+import death_stranding_text_repacker as repacker
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+text_type_hash = next(type_hash for type_hash, type_info in decima.pc_type_map.items()
+                      if type_info[1] is decima.LocalizedTextResource)
+# Mix of 1, 2 and 3 byte UTF-8 characters, so encoded sizes differ from character counts like real text does
+text_alphabet = 'abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ .,!?0123456789 éèüößçñ ЖЯй あいうカタ漢字'
+
+
+def random_text(rng: random.Random, min_length: int, max_length: int) -> str:
+    length = min(int(rng.triangular(min_length, max_length, min_length + (max_length - min_length) / 4)), max_length)
+    text = ''.join(rng.choices(text_alphabet, k=length))
+    # Slot sizes are 16-bit
+    while len(text.encode('utf8')) > 0xFFFF:
+        text = text[:len(text) // 2]
+    return text
+
+
+def generate_core(core_path: str, texts: int, blobs: int, text_length: Tuple[int, int] = (0, 200),
+                  blob_size: Tuple[int, int] = (16, 4096), seed: int = 0):
+    # Writes a core of LocalizedTextResources (every ETextLanguages slot filled) and unknown blobs, in random order
+    rng = random.Random(seed)
+    kinds = [True] * texts + [False] * blobs
+    rng.shuffle(kinds)
+    blob_type_hash = rng.getrandbits(64)
+    while blob_type_hash in decima.pc_type_map:
+        blob_type_hash = rng.getrandbits(64)
+    with open(core_path, 'wb') as out_file:
+        for is_text in kinds:
+            uuid = rng.getrandbits(128).to_bytes(16, 'little')
+            if is_text:
+                body = bytearray(uuid)
+                for _ in decima.ETextLanguages:
+                    val = random_text(rng, *text_length).encode('utf8')
+                    body += decima.text_size_struct.pack(len(val))
+                    body += val
+                    body += rng.getrandbits(24).to_bytes(3, 'little')
+                out_file.write(decima.object_header_struct.pack(text_type_hash, len(body)))
+                out_file.write(body)
+            else:
+                size = rng.randint(*blob_size)
+                out_file.write(decima.object_header_struct.pack(blob_type_hash, size + 16))
+                out_file.write(uuid)
+                out_file.write(rng.getrandbits(8 * size).to_bytes(size, 'little') if size else b'')
+
+
+def translate_dump(json_path: str, ratio: float, seed: int = 0):
+    # Fills in a translation for the given fraction of the records in a dump
+    rng = random.Random(seed)
+    records = list(repacker.read_records(json_path))
+    for record in records:
+        if rng.random() < ratio:
+            record['translation'] = record['text'][::-1]
+    with open(json_path, 'w', encoding='utf8') as out_file:
+        repacker.write_records(out_file, iter(records), json_path.endswith('.jsonl'))
+
+
+def peak_rss() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports KiB, macOS bytes
+
+
+def bench_read(core_path: str, work_dir: str) -> int:
+    script_objects = {}
+    decima.read_objects(core_path, script_objects)
+    return len(script_objects)
+
+
+def bench_read_mmap(core_path: str, work_dir: str) -> int:
+    script_objects = {}
+    decima.read_objects(core_path, script_objects, use_mmap=True)
+    return len(script_objects)
+
+
+def bench_dump(core_path: str, work_dir: str) -> int:
+    return len(repacker.dump_core(core_path, os.path.join(work_dir, 'dump.json')))
+
+
+def setup_repack(core_path: str, work_dir: str):
+    # Fresh copy for every run, made outside the timed region
+    shutil.copyfile(core_path, os.path.join(work_dir, 'repack.core'))
+
+
+def bench_repack(core_path: str, work_dir: str) -> int:
+    # Repacks the copy made by setup_repack, against the translated dump prepared by run_benchmarks
+    return repacker.repack_core(os.path.join(work_dir, 'repack.core'), os.path.join(work_dir, 'translated.json'),
+                                force=True)
+
+
+def bench_round_trip(core_path: str, work_dir: str) -> int:
+    # Parses every text and re-serializes it, checking the output is byte-identical to the original record
+    with open(core_path, 'rb') as core_file:
+        data = core_file.read()
+    script_objects = {}
+    decima.read_objects_from_stream(decima.MappedStream(data), decima.pc_type_map, script_objects)
+    count = 0
+    for header in decima.scan_headers(data):
+        obj = script_objects[header.uuid]
+        if isinstance(obj, decima.LocalizedTextResource):
+            record = data[header.offset:header.offset + 12 + header.size]
+            if decima.serialize_localized_text(obj) != record:
+                raise Exception('{} did not round-trip'.format(obj))
+            count += 1
+    return count
+
+
+benchmarks: Dict[str, Callable[[str, str], int]] = {
+    'read': bench_read,
+    'read-mmap': bench_read_mmap,
+    'dump': bench_dump,
+    'repack': bench_repack,
+    'round-trip': bench_round_trip,
+}
+# Untimed per-run preparation
+setups: Dict[str, Callable[[str, str], None]] = {
+    'repack': setup_repack,
+}
+
+
+def spawn_worker() -> ProcessPoolExecutor:
+    # Spawned rather than forked: a forked child inherits the parent's peak RSS, which would then be counted
+    # against whichever benchmark runs in it
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+
+def prepare(core_path: str, work_dir: str, translate: bool, translate_ratio: float) -> int:
+    # Runs in a spawned worker too, so the memory used here never shows up in a benchmark's peak RSS.
+    # Returns the number of objects in the core.
+    if translate:
+        translated_path = os.path.join(work_dir, 'translated.json')
+        repacker.dump_core(core_path, translated_path)
+        translate_dump(translated_path, translate_ratio)
+    return len(decima.read_index(core_path))
+
+
+def run_one(name: str, core_path: str, work_dir: str, repeat: int) -> Tuple[float, int, Optional[int]]:
+    # Runs in its own freshly spawned worker process, so peak RSS belongs to this benchmark alone
+    best = float('inf')
+    count = 0
+    setup = setups.get(name)
+    for _ in range(repeat):
+        if setup is not None:
+            setup(core_path, work_dir)
+        start = time.perf_counter()
+        count = benchmarks[name](core_path, work_dir)
+        best = min(best, time.perf_counter() - start)
+    return best, count, peak_rss()
+
+
+def run_benchmarks(core_path: str, names: List[str], repeat: int, translate_ratio: float) -> List[dict]:
+    core_size = os.path.getsize(core_path)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        with spawn_worker() as executor:
+            object_count = executor.submit(prepare, core_path, work_dir, 'repack' in names, translate_ratio).result()
+        for name in names:
+            with spawn_worker() as executor:
+                seconds, count, rss = executor.submit(run_one, name, core_path, work_dir, repeat).result()
+            results.append({
+                'benchmark': name,
+                'seconds': seconds,
+                'mb_per_s': core_size / seconds / 1e6,
+                'objects_per_s': object_count / seconds,
+                'processed': count,
+                'peak_rss_mb': rss / 1e6 if rss is not None else None})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks core parsing, dumping and repacking on synthetic cores.")
+    parser.add_argument('-c', '--core', type=str,
+                        help="Benchmark an existing core instead of generating one.")
+    parser.add_argument('--texts', type=int, default=20000,
+                        help="Number of LocalizedTextResources in the generated core.")
+    parser.add_argument('--blobs', type=int, default=5000,
+                        help="Number of unknown resources in the generated core.")
+    parser.add_argument('--text-length', type=int, nargs=2, default=[0, 200], metavar=('MIN', 'MAX'),
+                        help="Range of characters per language slot (skewed towards short texts).")
+    parser.add_argument('--blob-size', type=int, nargs=2, default=[16, 4096], metavar=('MIN', 'MAX'),
+                        help="Range of unknown resource sizes in bytes.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--translate-ratio', type=float, default=0.5,
+                        help="Fraction of texts given a translation for the repack benchmark.")
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help="Runs per benchmark; the fastest is reported.")
+    parser.add_argument('-b', '--benchmarks', type=str, nargs='+', choices=list(benchmarks), default=list(benchmarks))
+    parser.add_argument('-o', '--output', type=str,
+                        help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        core_path = args.core
+        if core_path is None:
+            core_path = os.path.join(temp_dir, 'synthetic.core')
+            generate_core(core_path, args.texts, args.blobs, tuple(args.text_length), tuple(args.blob_size), args.seed)
+        print(f'{core_path}: {os.path.getsize(core_path) / 1e6:.1f} MB')
+        results = run_benchmarks(core_path, args.benchmarks, args.repeat, args.translate_ratio)
+
+    print(f'{"benchmark":<12} {"seconds":>9} {"MB/s":>9} {"objects/s":>11} {"peak RSS MB":>12}')
+    for result in results:
+        rss = f'{result["peak_rss_mb"]:.1f}' if result['peak_rss_mb'] is not None else 'n/a'
+        print(f'{result["benchmark"]:<12} {result["seconds"]:>9.3f} {result["mb_per_s"]:>9.1f} '
+              f'{result["objects_per_s"]:>11.0f} {rss:>12}')
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as out_file:
+            json.dump(results, out_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
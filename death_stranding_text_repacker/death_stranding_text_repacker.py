@@ -1,10 +1,15 @@
-import io
 import os
+import sys
 import json
-import struct
+import time
+import shutil
+import hashlib
 import binascii
 import argparse
-from typing import Dict
+import tempfile
+from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, BinaryIO, List, Tuple, Optional, TextIO, Iterable, Iterator, Sequence
 import ds_decima as decima
 
 
@@ -12,72 +17,384 @@ simpletext_header = ['UUID', 'Text', 'Translation']
 language = decima.ETextLanguages.English
 
 
-def dump_core(core_path: str, json_path: str):
-    script_objects = {}
-    decima.read_objects(core_path, script_objects)
-    out_list = []
-    for obj in script_objects.values():
-        if isinstance(obj, decima.LocalizedTextResource):
-            out_list.append({
-                'uuid': binascii.hexlify(obj.uuid).decode('ASCII'),
-                'text': obj.language[language].text,
-                'translation': ''})
-    with open(json_path, 'w', encoding='utf8') as out_file:
-        out_file.write(json.dumps(out_list, indent=2, ensure_ascii=False))
+translation_exts = ('.json', '.jsonl')
+uuid_index_name = 'uuid_index.json'
+
+
+def dump_core(core_path: str, json_path: str, languages: Sequence[decima.ETextLanguages] = (language,),
+              skip_empty=False, dedup=False) -> List[str]:
+    # Records are written as they are decoded, so memory use doesn't grow with the number of texts. Dumping anything
+    # other than just the default language writes one record per text and language, tagged with the language name.
+    # With dedup, identical texts (per language) are merged into one record listing all of their UUIDs.
+    # Returns the UUIDs of the dumped texts; with skip_empty, nothing is written for a core without any texts.
+    tag_language = list(languages) != [language]
+    index = decima.read_index(core_path)
+    uuids = list(index.uuids_of_type(decima.LocalizedTextResource))
+    if skip_empty and not uuids:
+        return []
 
+    def records():
+        for uuid in uuids:
+            text = index.parse(uuid)
+            for lang in languages:
+                record = {'uuid': binascii.hexlify(uuid).decode('ASCII')}
+                if tag_language:
+                    record['language'] = lang.name
+                record['text'] = text.language[lang].text
+                record['translation'] = ''
+                yield record
+
+    with open(json_path, 'w', encoding='utf8') as out_file:
+        write_records(out_file, dedup_records(records()) if dedup else records(), json_path.endswith('.jsonl'))
+    return [binascii.hexlify(uuid).decode('ASCII') for uuid in uuids]
 
-def serialize_localized_text(text: decima.LocalizedTextResource):
-    output = text.uuid
 
-    for lang in text.language:
-        val = lang.text.encode('utf8')
-        output += struct.pack('<H', len(val))
-        output += val
-        output += lang.unks
+def dedup_records(records: Iterable[dict]) -> Iterator[dict]:
+    # Groups records with the same language and text into one translation unit, in order of first appearance
+    groups: Dict[Tuple[Optional[str], str], dict] = {}
+    for record in records:
+        key = (record.get('language'), record['text'])
+        group = groups.get(key)
+        if group is None:
+            group = {'uuids': []}
+            group.update((k, v) for k, v in record.items() if k != 'uuid')
+            groups[key] = group
+        group['uuids'].append(record['uuid'])
+    return iter(groups.values())
 
-    output = struct.pack('<QI', text.type_hash, len(output)) + output
-    return output
 
+def write_records(out_file: TextIO, records: Iterable[dict], json_lines=False):
+    if json_lines:
+        for record in records:
+            out_file.write(json.dumps(record, ensure_ascii=False))
+            out_file.write('\n')
+        return
+    # Same layout json.dumps(list, indent=2) would produce, one record at a time
+    first = True
+    for record in records:
+        out_file.write('[\n  ' if first else ',\n  ')
+        out_file.write(json.dumps(record, indent=2, ensure_ascii=False).replace('\n', '\n  '))
+        first = False
+    out_file.write('[]' if first else '\n]')
 
-def repack_core(core_path: str, json_path: str):
-    text_map: Dict[bytes, str] = dict()
 
+def read_records(json_path: str) -> Iterator[dict]:
     with open(json_path, 'r', encoding='utf8') as json_file:
-        contents = json.loads(json_file.read())
-        for line in contents:
-            obj_hash = binascii.unhexlify(line['uuid'])
-            new_text = line['translation']
-            text_map[obj_hash] = new_text if new_text != '' else line['text']
-
-    with open(core_path, 'r+b') as core_file:
-        orig_core = io.BytesIO(core_file.read())
-        core_file.seek(0)
-        core_file.truncate(0)
-        while True:
-            start = orig_core.tell()
-            obj_type = orig_core.read(8)
-            if len(obj_type) < 8:
+        if json_path.endswith('.jsonl'):
+            for line in json_file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(json_file)
+
+
+def translation_path(core_path: str) -> str:
+    # JSON dump beside the core, falling back to a JSON Lines dump if there is no .json
+    stem = os.path.splitext(core_path)[0]
+    for ext in translation_exts:
+        if os.path.isfile(stem + ext):
+            return stem + ext
+    return stem + translation_exts[0]
+
+
+# FAT and SMB store modification times to the nearest 2 seconds, so a translation file saved again within that window
+# of the previous save can keep its mtime. One modified that close to its manifest being written is hashed, not trusted.
+mtime_granularity_ns = 2 * 10 ** 9
+
+
+class RepackManifest:
+    # Written beside a core after each repack, recording the size, mtime and SHA-256 of the repacked core and of the
+    # JSON file it was repacked from. Files are compared by size and mtime first and only hashed when those differ, so
+    # checking a core that is already up to date doesn't read either file.
+    def __init__(self, core: dict, translations: dict, written_ns: int):
+        self.core = core
+        self.translations = translations
+        self.written_ns = written_ns
+
+    @staticmethod
+    def path(core_path: str) -> str:
+        return core_path + '.manifest'
+
+    @staticmethod
+    def digest(path: str) -> str:
+        # SHA-256 of a file, read unbuffered into one reused 1 MB buffer
+        digest = hashlib.sha256()
+        buffer = bytearray(1 << 20)
+        view = memoryview(buffer)
+        with open(path, 'rb', buffering=0) as in_file:
+            for size in iter(lambda: in_file.readinto(buffer), 0):
+                digest.update(view[:size])
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_state(path: str, sha256: Optional[str]) -> dict:
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+
+    @classmethod
+    def load(cls, core_path: str) -> Optional['RepackManifest']:
+        try:
+            with open(cls.path(core_path), 'r', encoding='utf8') as manifest_file:
+                manifest = json.load(manifest_file)
+            return cls(manifest['core'], manifest['translations'], manifest['written_ns'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @classmethod
+    def record(cls, core_path: str, json_path: str, translations_digest: str) -> 'RepackManifest':
+        manifest = cls(cls.file_state(core_path, cls.digest(core_path)),
+                       cls.file_state(json_path, translations_digest), time.time_ns())
+        manifest.save(core_path)
+        return manifest
+
+    def save(self, core_path: str):
+        with open(self.path(core_path), 'w', encoding='utf8') as manifest_file:
+            json.dump({'core': self.core, 'translations': self.translations, 'written_ns': self.written_ns},
+                      manifest_file, indent=2)
+
+    def unchanged(self, path: str, state: dict, trust_mtime: bool) -> bool:
+        stat = os.stat(path)
+        if stat.st_size != state['size']:
+            return False
+        if stat.st_mtime_ns == state['mtime_ns'] and trust_mtime:
+            return True
+        return state['sha256'] is not None and self.digest(path) == state['sha256']
+
+    def matches(self, core_path: str, json_path: str) -> bool:
+        # The core is only ever rewritten by the repack itself, so its mtime is trusted as is
+        racy = self.translations['mtime_ns'] > self.written_ns - mtime_granularity_ns
+        if not (self.unchanged(core_path, self.core, True) and
+                self.unchanged(json_path, self.translations, not racy)):
+            return False
+        core_mtime_ns = os.stat(core_path).st_mtime_ns
+        json_mtime_ns = os.stat(json_path).st_mtime_ns
+        if racy or core_mtime_ns != self.core['mtime_ns'] or json_mtime_ns != self.translations['mtime_ns']:
+            # Hashed and unchanged; re-saved with the current mtimes so the next check can go by size and mtime alone
+            self.core['mtime_ns'] = core_mtime_ns
+            self.translations['mtime_ns'] = json_mtime_ns
+            self.written_ns = time.time_ns()
+            self.save(core_path)
+        return True
+
+
+def repack_core(core_path: str, json_path: str, force=False) -> Optional[int]:
+    # Returns the number of texts patched, or None if the core was skipped because it is already up to date
+    if not force:
+        manifest = RepackManifest.load(core_path)
+        if manifest is not None and manifest.matches(core_path, json_path):
+            return None
+    translations_digest = RepackManifest.digest(json_path)
+
+    # Every language found in the file is repacked in the same pass
+    text_map: Dict[bytes, Dict[decima.ETextLanguages, str]] = dict()
+
+    for line in read_records(json_path):
+        lang = decima.ETextLanguages[line['language']] if 'language' in line else language
+        new_text = line['translation'] if line['translation'] != '' else line['text']
+        # Deduplicated records fan out to every UUID they list
+        for uuid in line['uuids'] if 'uuids' in line else [line['uuid']]:
+            text_map.setdefault(binascii.unhexlify(uuid), {})[lang] = new_text
+
+    # Write to a temporary file next to the core and swap it in at the end, so a failed repack leaves the original
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(core_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out_file:
+            patched = write_repacked_core(core_path, out_file, text_map)
+        shutil.copymode(core_path, temp_path)
+        os.replace(temp_path, core_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    RepackManifest.record(core_path, json_path, translations_digest)
+    return patched
+
+
+def write_repacked_core(core_path: str, out_file: BinaryIO, text_map: Dict[bytes, Dict[decima.ETextLanguages, str]]):
+    patched = 0
+    with open(core_path, 'rb') as core_file:
+        orig_core = decima.map_file(core_file)
+        copy_start = 0
+        for header in decima.scan_headers(orig_core):
+            if header.uuid not in text_map or \
+                    decima.pc_type_map.get(header.type_hash, [''])[0] != 'LocalizedTextResource':
+                continue
+            # Unchanged objects between patched texts are copied as a single range
+            end = header.offset + 12 + header.size
+            out_file.write(orig_core[copy_start:header.offset])
+            text = decima.LazyLocalizedTextResource(orig_core[header.offset:end])
+            for lang, new_text in text_map[header.uuid].items():
+                text.language[lang].text = new_text
+            out_file.write(decima.serialize_localized_text(text))
+            copy_start = end
+            patched += 1
+        out_file.write(orig_core[copy_start:])
+    return patched
+
+
+def dump_tree_core(core_path: str, ext: str, languages: Sequence[decima.ETextLanguages], dedup: bool,
+                   force: bool) -> Tuple[List[str], bool]:
+    # Returns the UUIDs of the core's texts and whether it was dumped. A JSON or JSONL file already beside the core may
+    # hold a translator's work, so it is kept (and only the UUIDs are read) unless force is set.
+    stem = os.path.splitext(core_path)[0]
+    if not force and any(os.path.exists(stem + existing_ext) for existing_ext in translation_exts):
+        uuids = decima.read_index(core_path).uuids_of_type(decima.LocalizedTextResource)
+        return [binascii.hexlify(uuid).decode('ASCII') for uuid in uuids], False
+    return dump_core(core_path, stem + ext, languages, True, dedup), True
+
+
+def dump_tree(root: str, languages: Sequence[decima.ETextLanguages] = (language,), json_lines=False,
+              jobs: Optional[int] = None, dedup=False, force=False) -> List[str]:
+    # Dumps every core with texts under root beside itself, and writes an index of text UUID -> core path to root
+    core_paths = []
+    for dir_path, _, file_names in os.walk(root):
+        core_paths.extend(os.path.join(dir_path, file_name) for file_name in file_names if file_name.endswith('.core'))
+    core_paths.sort()
+    ext = '.jsonl' if json_lines else '.json'
+
+    failed = []
+    kept = []
+    core_uuids: Dict[str, List[str]] = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(dump_tree_core, core_path, ext, languages, dedup, force): core_path
+                   for core_path in core_paths}
+        for i, future in enumerate(as_completed(futures), 1):
+            core_path = futures[future]
+            try:
+                uuids, dumped = future.result()
+            except Exception as e:
+                failed.append(core_path)
+                print(f'[{i}/{len(core_paths)}] {core_path}: failed: {e}')
+                continue
+            if uuids:
+                core_uuids[core_path] = uuids
+                if dumped:
+                    print(f'[{i}/{len(core_paths)}] {core_path}: {len(uuids)} texts dumped')
+                else:
+                    kept.append(core_path)
+                    print(f'[{i}/{len(core_paths)}] {core_path}: already dumped, kept (use --force to overwrite)')
+
+    uuid_index: Dict[str, str] = {}
+    duplicates = 0
+    for core_path in sorted(core_uuids):
+        relative_path = PurePath(os.path.relpath(core_path, root)).as_posix()
+        for uuid in core_uuids[core_path]:
+            if uuid in uuid_index:
+                duplicates += 1
+            else:
+                uuid_index[uuid] = relative_path
+    with open(os.path.join(root, uuid_index_name), 'w', encoding='utf8') as index_file:
+        json.dump(uuid_index, index_file, indent=2)
+
+    print(f'{len(core_uuids)} of {len(core_paths)} cores had text, {len(uuid_index)} texts indexed; '
+          f'{len(kept)} existing dumps kept.')
+    if duplicates:
+        print(f'{duplicates} UUIDs appeared in more than one core; the index points to the first.')
+    if failed:
+        print('Failed cores:')
+        for core_path in sorted(failed):
+            print(f'  {core_path}')
+    return failed
+
+
+def verify_repack(orig_path: str, repacked_path: str) -> Tuple[int, int, List[str]]:
+    # Walks both cores once, side by side. Objects must appear in the same order with the same UUIDs and types;
+    # only LocalizedTextResources may differ, and those must re-parse to exactly their header size.
+    # Returns (identical objects, modified texts, problems).
+    problems = []
+    identical = 0
+    modified = 0
+    with open(orig_path, 'rb') as orig_file, open(repacked_path, 'rb') as repacked_file:
+        orig_core = decima.map_file(orig_file)
+        repacked_core = decima.map_file(repacked_file)
+        orig_map, repacked_map = orig_core.obj, repacked_core.obj
+        try:
+            orig_headers = decima.scan_headers(orig_core)
+            repacked_headers = decima.scan_headers(repacked_core)
+        except Exception as e:
+            return identical, modified, [str(e)]
+        if len(orig_headers) != len(repacked_headers):
+            problems.append(f'Object count changed from {len(orig_headers)} to {len(repacked_headers)}')
+
+        for orig, repacked in zip(orig_headers, repacked_headers):
+            uuid = binascii.hexlify(orig.uuid).decode('ASCII')
+            if orig.uuid != repacked.uuid or orig.type_hash != repacked.type_hash:
+                problems.append(f'Object at offset {orig.offset} ({uuid}) was replaced by '
+                                f'{binascii.hexlify(repacked.uuid).decode("ASCII")}; objects are out of order')
                 break
-            str_type = '{0:X}'.format(struct.unpack('<Q', obj_type)[0])
-            obj_size = struct.unpack('<I', orig_core.read(4))[0]
-            obj_uuid = orig_core.read(16)
-            orig_core.read(obj_size)
-
-            if str_type in decima.pc_type_map and decima.pc_type_map[str_type][0] == 'LocalizedTextResource'\
-                    and obj_uuid in text_map:
-                script_objects = {}
-                orig_core.seek(start)
-                resource_stream = io.BytesIO(orig_core.read(obj_size + 12))
-                decima.read_objects_from_stream(resource_stream, decima.pc_type_map, script_objects)
-                assert(len(script_objects) == 1)
-                text = script_objects[obj_uuid]
-                text.language[language].text = text_map[obj_uuid]
-                serialized_text = serialize_localized_text(text)
-                core_file.write(serialized_text)
+            # Compared as bytes sliced from the mappings themselves, which is a memcmp; comparing the memoryviews
+            # would go element by element
+            if orig.size == repacked.size and orig_map[orig.offset:orig.offset + 12 + orig.size] == \
+                    repacked_map[repacked.offset:repacked.offset + 12 + repacked.size]:
+                identical += 1
+                continue
+            if decima.pc_type_map.get(orig.type_hash, [''])[0] != 'LocalizedTextResource':
+                problems.append(f'{uuid} is not a LocalizedTextResource but was modified')
+                continue
+            try:
+                text = decima.LazyLocalizedTextResource(
+                    repacked_core[repacked.offset:repacked.offset + 12 + repacked.size])
+                for _ in text.language:  # Decode every slot
+                    pass
+            except Exception as e:
+                problems.append(f'Text {uuid} does not re-parse: {e}')
+                continue
+            modified += 1
+    return identical, modified, problems
+
+
+def find_core_pairs(root: str, pair_exts: Tuple[str, ...]) -> List[Tuple[str, str]]:
+    # Pairs each core with the first of pair_exts that exists beside it
+    pairs = []
+    for dir_path, _, file_names in os.walk(root):
+        names = set(file_names)
+        for file_name in file_names:
+            stem, ext = os.path.splitext(file_name)
+            if ext != '.core':
+                continue
+            pair_name = next((stem + pair_ext for pair_ext in pair_exts if stem + pair_ext in names), None)
+            if pair_name is not None:
+                pairs.append((os.path.join(dir_path, file_name), os.path.join(dir_path, pair_name)))
+    pairs.sort()
+    return pairs
+
+
+def repack_tree(root: str, jobs: Optional[int] = None, force=False) -> List[str]:
+    # One process pool for the whole tree, so interpreter startup and imports are paid once per worker
+    pairs = find_core_pairs(root, translation_exts)
+    failed = []
+    skipped = 0
+    patched_total = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(repack_core, core_path, json_path, force): core_path
+                   for core_path, json_path in pairs}
+        for i, future in enumerate(as_completed(futures), 1):
+            core_path = futures[future]
+            try:
+                patched = future.result()
+            except Exception as e:
+                failed.append(core_path)
+                print(f'[{i}/{len(pairs)}] {core_path}: failed: {e}')
+                continue
+            if patched is None:
+                skipped += 1
+                print(f'[{i}/{len(pairs)}] {core_path}: up to date, skipped')
             else:
-                # Copy data without modifying
-                orig_core.seek(start)
-                core_file.write(orig_core.read(obj_size + 12))
+                patched_total += patched
+                print(f'[{i}/{len(pairs)}] {core_path}: {patched} texts repacked')
+    print(f'{len(pairs) - len(failed) - skipped} of {len(pairs)} cores repacked ({skipped} up to date), '
+          f'{patched_total} texts in total.')
+    if failed:
+        print('Failed cores:')
+        for core_path in sorted(failed):
+            print(f'  {core_path}')
+    return failed
+
+
+def parse_language(name: str) -> decima.ETextLanguages:
+    for lang in decima.ETextLanguages:
+        if lang.name.lower() == name.lower():
+            return lang
+    raise argparse.ArgumentTypeError('unknown language: {}'.format(name))
 
 
 def main():
@@ -87,17 +404,53 @@ def main():
                        help="Path to a core file to dump.")
     group.add_argument('-r', '--repack', type=str,
                        help="Path to a core file to repack.")
+    group.add_argument('--verify', type=str, nargs=2, metavar=('ORIGINAL', 'REPACKED'),
+                       help="Check a repacked core against the original it was made from.")
+    group.add_argument('--dump-tree', type=str,
+                       help="Path to a directory; every core in it with text will be dumped beside itself.")
+    group.add_argument('--repack-tree', type=str,
+                       help="Path to a directory; every core in it with a JSON (or JSONL) file beside it will be "
+                            "repacked.")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Number of worker processes for --dump-tree and --repack-tree (defaults to the CPU "
+                             "count).")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Repack even if the core and its JSON file are unchanged since the last repack, or with "
+                             "--dump-tree, overwrite JSON files that already exist.")
+    parser.add_argument('--jsonl', action='store_true',
+                        help="Dump to JSON Lines (.jsonl, one record per line) instead of a JSON array.")
+    parser.add_argument('-l', '--languages', type=parse_language, nargs='+', default=[language],
+                        help="Languages to dump (e.g. English French German). Defaults to English only.")
+    parser.add_argument('--dedup', action='store_true',
+                        help="Dump each distinct text once, with the list of UUIDs that share it.")
     args = parser.parse_args()
     if args.dump:
-        json_path = os.path.splitext(args.dump)[0] + '.json'
+        json_path = os.path.splitext(args.dump)[0] + ('.jsonl' if args.jsonl else '.json')
         assert os.path.isfile(args.dump)
-        dump_core(args.dump, json_path)
+        dump_core(args.dump, json_path, args.languages, dedup=args.dedup)
         print('JSON file generated.')
     elif args.repack:
-        json_path = os.path.splitext(args.repack)[0] + '.json'
+        json_path = translation_path(args.repack)
         assert os.path.isfile(args.repack)
-        repack_core(args.repack, json_path)
-        print('Updated text repacked into core.')
+        if repack_core(args.repack, json_path, args.force) is None:
+            print('Core is already up to date with its JSON file, skipping (use --force to repack anyway).')
+        else:
+            print('Updated text repacked into core.')
+    elif args.verify:
+        identical, modified, problems = verify_repack(*args.verify)
+        for problem in problems:
+            print(problem)
+        print(f'{identical} objects identical, {modified} texts modified, {len(problems)} problems found.')
+        if problems:
+            sys.exit(1)
+    elif args.dump_tree:
+        assert os.path.isdir(args.dump_tree)
+        if dump_tree(args.dump_tree, args.languages, args.jsonl, args.jobs, args.dedup, args.force):
+            sys.exit(1)
+    elif args.repack_tree:
+        assert os.path.isdir(args.repack_tree)
+        if repack_tree(args.repack_tree, args.jobs, args.force):
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -2,14 +2,22 @@ import binascii
 import struct
 import os
 import io
+import mmap
 from enum import IntEnum
+from collections import OrderedDict
 
-from typing import Dict, BinaryIO, TypeVar, Generic, List, Any
+from typing import Dict, BinaryIO, TypeVar, Generic, List, Any, NamedTuple, Iterator, Optional, Tuple
+from collections.abc import Mapping, MutableMapping, Sequence
 
 script_dir = os.path.dirname(__file__)
 pc_path_file = os.path.join(script_dir, r'hzd_root_path.txt')
 game_root_pc = open(pc_path_file, 'r').read().strip('" \t\r\n') if os.path.isfile(pc_path_file) else ''
 T = TypeVar('T')
+object_header_struct = struct.Struct('<QI')
+text_size_struct = struct.Struct('<H')
+# Optional UUID index (anything with a read_record(uuid) -> Optional[bytes] method, such as core_index.CoreIndex).
+# Ref.follow falls back to it for refs that can't be resolved otherwise, including refs without a path.
+uuid_index = None
 
 
 class ETextLanguages(IntEnum):
@@ -41,16 +49,17 @@ class ETextLanguages(IntEnum):
 
 
 class Resource:
+    # Slotted, as a single core can hold tens of thousands of resources
+    __slots__ = ('type_hash', 'type', 'size', 'uuid')
+
     def __init__(self, stream: BinaryIO):
-        self.type_hash = struct.unpack('<Q', stream.read(8))[0]
-        little_endian_type = '{0:X}'.format(self.type_hash)
+        self.type_hash, self.size = object_header_struct.unpack(stream.read(12))
         type_map = pc_type_map
-        if little_endian_type in type_map:
-            self.type = type_map[little_endian_type][0]
+        if self.type_hash in type_map:
+            self.type = type_map[self.type_hash][0]
         else:
             self.type = 'Unknown Type'
-        self.size = struct.unpack('<I', stream.read(4))[0]
-        self.uuid = stream.read(16)
+        self.uuid = bytes(stream.read(16))
 
     def __str__(self):
         return '{}: {}'.format(self.type, binascii.hexlify(self.uuid).decode('ASCII'))
@@ -60,31 +69,43 @@ class Resource:
 
 
 class Ref(Generic[T]):
+    __slots__ = ('type', 'hash', 'path')
+
     def __init__(self, stream: BinaryIO):
         self.type: int = struct.unpack('<B', stream.read(1))[0]
-        if self.type > 0:
-            self.hash: bytes = stream.read(16)
-        if self.type in [2, 3]:
-            self.path: str = parse_hashed_string(stream)
+        self.hash: Optional[bytes] = bytes(stream.read(16)) if self.type > 0 else None
+        self.path: Optional[str] = parse_hashed_string(stream) if self.type in [2, 3] else None
 
     def follow(self, resource_dict: Dict[bytes, Resource]) -> T:
         if self.type == 0:
             return None
         if self.hash in resource_dict:
             return resource_dict[self.hash]
-        elif hasattr(self, 'path'):
+        elif self.path is not None:
             game_root = game_root_pc
             full_path = os.path.join(game_root, self.path) + '.core'
-            read_objects(full_path, resource_dict)
+            if isinstance(resource_dict, ResourceIndex):
+                resource_dict.add_file(full_path)
+            else:
+                # Shared with core_cache and every other dict that followed into this core; don't mutate them
+                objects = core_cache.lookup(full_path, self.hash)
+                if objects is not None:
+                    resource_dict.update(objects)
             if self.hash in resource_dict:
                 return resource_dict[self.hash]
+        if uuid_index is not None:
+            record = uuid_index.read_record(self.hash)
+            if record is not None:
+                read_objects_from_stream(io.BytesIO(record), pc_type_map, resource_dict)
+                if self.hash in resource_dict:
+                    return resource_dict[self.hash]
         raise Exception('Resource not in list: {}'.format(self.__str__()))
 
     def __str__(self):
         ret = 'Type {} Ref: '.format(self.type)
-        if hasattr(self, 'hash'):
+        if self.hash is not None:
             ret += binascii.hexlify(self.hash).decode('ASCII')
-        if hasattr(self, 'path'):
+        if self.path is not None:
             ret += ', ' + self.path
         return ret
 
@@ -93,6 +114,8 @@ class Ref(Generic[T]):
 
 
 class UnknownResource(Resource):
+    __slots__ = ('data',)
+
     def __init__(self, stream: BinaryIO):
         start_pos = stream.tell()
         Resource.__init__(self, stream)
@@ -105,16 +128,35 @@ class UnknownResource(Resource):
 
 
 class LocalizedTextResource(Resource):
+    __slots__ = ('language',)
+
     class Localization:
-        def __init__(self, stream: BinaryIO):
-            self.size = struct.unpack('<H', stream.read(2))[0]
-            self.text = stream.read(self.size).decode('UTF8')
-            self.unks = stream.read(3)
+        __slots__ = ('size', 'text', 'unks')
+
+        def __init__(self, text: str, unks: bytes, size: Optional[int] = None):
+            self.size = size if size is not None else len(text.encode('UTF8'))
+            self.text = text
+            self.unks = unks
+
+        @staticmethod
+        def decode(view: memoryview, pos: int) -> Tuple['LocalizedTextResource.Localization', int]:
+            size = text_size_struct.unpack_from(view, pos)[0]
+            pos += text_size_struct.size
+            end = pos + size
+            return LocalizedTextResource.Localization(str(view[pos:end], 'UTF8'), bytes(view[end:end + 3]), size), \
+                end + 3
 
     def __init__(self, stream: BinaryIO):
         Resource.__init__(self, stream)
-        self.language: List[LocalizedTextResource.Localization] \
-            = [LocalizedTextResource.Localization(stream) for _ in ETextLanguages]
+        # Read the whole body at once and decode every slot from a single memoryview cursor
+        body = memoryview(stream.read(max(self.size - 16, 0)))
+        self.language: List[LocalizedTextResource.Localization] = []
+        pos = 0
+        for _ in ETextLanguages:
+            loc, pos = LocalizedTextResource.Localization.decode(body, pos)
+            self.language.append(loc)
+        if pos != len(body):
+            raise Exception("didn't match size, expected {}, read {}".format(self.size + 12, pos + 28))
 
     def __str__(self):
         return self.language[ETextLanguages.English].text.strip()
@@ -123,15 +165,146 @@ class LocalizedTextResource(Resource):
         return self.language[ETextLanguages.English].text.__repr__()
 
 
-pc_type_map = {'31BE502435317445': ["LocalizedTextResource", LocalizedTextResource]}
+# Keyed by the integer type hash, so headers can be looked up without formatting a string per object
+pc_type_map = {0x31BE502435317445: ["LocalizedTextResource", LocalizedTextResource]}
+
+
+class HexKeyView(Mapping):
+    # Read-only view of an integer-keyed type map under the old hex string keys ('{0:X}'.format(type_hash))
+    def __init__(self, type_map: Dict[int, List[Any]]):
+        self.type_map = type_map
+
+    def __getitem__(self, key: str):
+        try:
+            return self.type_map[int(key, 16)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return ('{0:X}'.format(type_hash) for type_hash in self.type_map)
+
+    def __len__(self):
+        return len(self.type_map)
+
+
+pc_type_map_hex = HexKeyView(pc_type_map)
+
+
+def serialize_localized_text(text: LocalizedTextResource) -> bytearray:
+    out = bytearray(object_header_struct.size)
+    out += text.uuid
+    pack_size = text_size_struct.pack
+    for lang in text.language:
+        val = lang.text.encode('UTF8')
+        out += pack_size(len(val))
+        out += val
+        out += lang.unks
+    object_header_struct.pack_into(out, 0, text.type_hash, len(out) - object_header_struct.size)
+    return out
+
+
+def map_file(in_file: BinaryIO) -> memoryview:
+    # The mapping stays alive for as long as any memoryview still references part of it
+    if os.fstat(in_file.fileno()).st_size == 0:
+        return memoryview(b'')
+    return memoryview(mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class MappedStream:
+    # Read-only stream over a buffer (usually a mapped file). read() returns memoryview slices instead of copies.
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.pos = 0
+
+    def read(self, size: int = -1) -> memoryview:
+        start = self.pos
+        if size is None or size < 0:
+            self.pos = len(self.view)
+        else:
+            self.pos = min(start + size, len(self.view))
+        return self.view[start:self.pos]
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(offset, 0)
+        return self.pos
+
+
+class CoreCache:
+    # Process-wide LRU of parsed cores used by Ref.follow. Entries are invalidated when a file's mtime or size changes.
+    # UUIDs a core was found not to contain are remembered separately, so a failed lookup doesn't re-read the core even
+    # after it has been evicted.
+    #
+    # The cache is bounded by the on-disk size of the cached files (max_file_bytes), not by the memory the parsed
+    # objects take, which is several times larger; size it with that in mind.
+    #
+    # lookup() returns the cached objects themselves, not copies: every dict that followed a Ref into the same core
+    # shares them with the cache. Treat followed resources as read-only; to edit one, parse its core into a dict of
+    # your own with read_objects so the change can't leak into other callers.
+    def __init__(self, max_file_bytes: int = 256 * 1024 * 1024, max_missing: int = 65536):
+        self.max_file_bytes = max_file_bytes
+        self.max_missing = max_missing
+        self.total_file_bytes = 0
+        self.cores: OrderedDict[str, Tuple[Tuple[int, int], Dict[bytes, Resource]]] = OrderedDict()
+        self.missing: OrderedDict[Tuple[str, Tuple[int, int], bytes], None] = OrderedDict()
+
+    def lookup(self, path: str, uuid: bytes) -> Optional[Dict[bytes, Resource]]:
+        # Returns the objects in the core at path, or None if the core is already known not to contain uuid
+        path = os.path.normcase(os.path.abspath(path))
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        missing_key = (path, version, uuid)
+        if missing_key in self.missing:
+            self.missing.move_to_end(missing_key)
+            return None
+
+        entry = self.cores.get(path)
+        if entry is not None and entry[0] == version:
+            self.cores.move_to_end(path)
+            objects = entry[1]
+        else:
+            if entry is not None:
+                self.evict(path)
+            objects = {}
+            read_objects(path, objects)
+            self.cores[path] = (version, objects)
+            self.total_file_bytes += version[1]
+            while self.total_file_bytes > self.max_file_bytes and len(self.cores) > 1:
+                self.evict(next(iter(self.cores)))
+
+        if uuid not in objects:
+            self.missing[missing_key] = None
+            if len(self.missing) > self.max_missing:
+                self.missing.popitem(last=False)
+        return objects
+
+    def evict(self, path: str):
+        version, _ = self.cores.pop(path)
+        self.total_file_bytes -= version[1]
 
+    def clear(self):
+        self.cores.clear()
+        self.missing.clear()
+        self.total_file_bytes = 0
 
-def read_objects(in_file_name: str, out_dict: Dict[bytes, Resource], use_buffering=False):
+
+core_cache = CoreCache()
+
+
+def read_objects(in_file_name: str, out_dict: Dict[bytes, Resource], use_buffering=False, use_mmap=False):
     type_map = pc_type_map
 
     with open(in_file_name, 'rb') as in_file:
         try:
-            return read_objects_from_stream(io.BytesIO(in_file.read()), type_map, out_dict, use_buffering)
+            # With use_mmap, UnknownResource.data holds memoryview slices of the mapped file rather than bytes copies
+            stream = MappedStream(map_file(in_file)) if use_mmap else io.BytesIO(in_file.read())
+            return read_objects_from_stream(stream, type_map, out_dict, use_buffering)
         except Exception as e:
             raise Exception(f'Error in {in_file_name}: {e}')
 
@@ -142,17 +315,14 @@ def read_objects_from_stream(in_file: io.BytesIO, type_map, out_dict: Dict[bytes
         if not in_file.read(1):
             break
         in_file.seek(start_pos)
-        type_hash, size = struct.unpack('<QI', in_file.read(12))
+        type_hash, size = object_header_struct.unpack(in_file.read(12))
         in_file.seek(start_pos)
         if use_buffering:
             stream = io.BytesIO(in_file.read(12 + size))
         else:
             stream = in_file
         # check type map to see if we have a dedicated constructor
-        little_endian_type = '{0:X}'.format(type_hash)
-        type_info: List[Any] = ["Unknown"]
-        if little_endian_type in type_map:
-            type_info = type_map[little_endian_type]
+        type_info: List[Any] = type_map.get(type_hash, ["Unknown"])
         if len(type_info) > 1:
             parse_start_pos = stream.tell()
 
@@ -176,7 +346,157 @@ def read_objects_from_stream(in_file: io.BytesIO, type_map, out_dict: Dict[bytes
             out_dict[unknown_res.uuid] = unknown_res
 
 
+class ResourceHeader(NamedTuple):
+    type_hash: int
+    offset: int
+    size: int
+    uuid: bytes
+
+
+def scan_headers(buffer) -> List[ResourceHeader]:
+    # Header-only pass over a core: records where each object lives without constructing any resources
+    view = memoryview(buffer)
+    headers = []
+    pos = 0
+    while pos < len(view):
+        if pos + 28 > len(view):
+            raise Exception('Truncated object header at offset {}'.format(pos))
+        type_hash, size = object_header_struct.unpack_from(view, pos)
+        if pos + 12 + size > len(view):
+            raise Exception('Object at offset {} runs past end of file'.format(pos))
+        headers.append(ResourceHeader(type_hash, pos, size, bytes(view[pos + 12:pos + 28])))
+        pos += 12 + size
+    return headers
+
+
+class LazyLocalizedTextResource(LocalizedTextResource):
+    # Stand-in for LocalizedTextResource that only decodes a language slot when it is first accessed
+    __slots__ = ()
+
+    class Languages(Sequence):
+        __slots__ = ('record', 'offsets', 'parsed')
+
+        def __init__(self, record: memoryview):
+            self.record = record
+            self.offsets: List[int] = []
+            pos = 28
+            for _ in ETextLanguages:
+                self.offsets.append(pos)
+                pos += text_size_struct.size + text_size_struct.unpack_from(record, pos)[0] + 3
+            if pos != len(record):
+                raise Exception("didn't match size, expected {}, read {}".format(len(record), pos))
+            self.parsed: List[Optional[LocalizedTextResource.Localization]] = [None] * len(self.offsets)
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return [self[i] for i in range(*index.indices(len(self)))]
+            loc = self.parsed[index]
+            if loc is None:
+                loc = LocalizedTextResource.Localization.decode(self.record, self.offsets[index])[0]
+                self.parsed[index] = loc
+            return loc
+
+        def __len__(self):
+            return len(self.offsets)
+
+    def __init__(self, record: memoryview):
+        Resource.__init__(self, MappedStream(record))
+        self.language = LazyLocalizedTextResource.Languages(record)
+
+
+lazy_types = {LocalizedTextResource: LazyLocalizedTextResource}
+
+
+class ResourceIndex(MutableMapping):
+    # Dict-like view over one or more mapped cores. Objects are located by a header scan and only parsed when looked
+    # up, so it can be passed anywhere a resource dict is expected (including Ref.follow).
+    def __init__(self, type_map=None):
+        self.type_map = type_map if type_map is not None else pc_type_map
+        self.headers: Dict[bytes, Tuple[memoryview, ResourceHeader]] = {}
+        self.parsed: Dict[bytes, Resource] = {}
+        self.files = set()
+
+    def add_file(self, in_file_name: str):
+        # Each file is only mapped and scanned once, however many refs point into it
+        file_key = os.path.normcase(os.path.abspath(in_file_name))
+        if file_key in self.files:
+            return
+        self.files.add(file_key)
+        with open(in_file_name, 'rb') as in_file:
+            try:
+                self.add_buffer(map_file(in_file))
+            except Exception as e:
+                raise Exception(f'Error in {in_file_name}: {e}')
+
+    def add_buffer(self, buffer):
+        view = memoryview(buffer)
+        for header in scan_headers(view):
+            self.headers[header.uuid] = (view, header)
+            self.parsed.pop(header.uuid, None)
+
+    def resource_class(self, type_hash: int):
+        type_info = self.type_map.get(type_hash, ["Unknown"])
+        return type_info[1] if len(type_info) > 1 else None
+
+    def uuids_of_type(self, resource_class) -> Iterator[bytes]:
+        for uuid, (_, header) in self.headers.items():
+            if self.resource_class(header.type_hash) is resource_class:
+                yield uuid
+
+    def __getitem__(self, uuid: bytes) -> Resource:
+        if uuid in self.parsed:
+            return self.parsed[uuid]
+        res = self.parse(uuid)
+        self.parsed[uuid] = res
+        return res
+
+    def parse(self, uuid: bytes) -> Resource:
+        # Parses the object without keeping it in the index, for single passes that shouldn't grow with the core
+        if uuid in self.parsed:
+            return self.parsed[uuid]
+        view, header = self.headers[uuid]
+        record = view[header.offset:header.offset + 12 + header.size]
+        lazy_class = lazy_types.get(self.resource_class(header.type_hash))
+        if lazy_class is not None:
+            try:
+                return lazy_class(record)
+            except Exception as e:
+                raise Exception("{} failed to parse: {}".format(binascii.hexlify(uuid).decode('ASCII'), e))
+        out_dict = {}
+        read_objects_from_stream(MappedStream(record), self.type_map, out_dict)
+        return out_dict[uuid]
+
+    def __setitem__(self, uuid: bytes, res: Resource):
+        self.parsed[uuid] = res
+
+    def __delitem__(self, uuid: bytes):
+        found = self.parsed.pop(uuid, None) is not None
+        found = self.headers.pop(uuid, None) is not None or found
+        if not found:
+            raise KeyError(uuid)
+
+    def __contains__(self, uuid):
+        return uuid in self.parsed or uuid in self.headers
+
+    def __iter__(self):
+        yield from self.headers
+        for uuid in self.parsed:
+            if uuid not in self.headers:
+                yield uuid
+
+    def __len__(self):
+        return len(self.headers) + sum(1 for uuid in self.parsed if uuid not in self.headers)
+
+
+def read_index(in_file_name: str) -> ResourceIndex:
+    index = ResourceIndex()
+    index.add_file(in_file_name)
+    return index
+
+
 class HashedString:
+    __slots__ = ('text_hash', 'text')
+
     def __init__(self, text_hash, text):
         self.text_hash = text_hash
         self.text = text
@@ -188,10 +508,10 @@ class HashedString:
 def parse_hashed_string(stream: BinaryIO, include_hash=False):
     size = struct.unpack('<I', stream.read(4))[0]
     if size > 0:
-        string_hash = stream.read(4)
+        string_hash = bytes(stream.read(4))
     else:
         string_hash = bytes()
     if include_hash:
-        return HashedString(string_hash, stream.read(size).decode('ASCII'))
+        return HashedString(string_hash, str(stream.read(size), 'ASCII'))
     else:
-        return stream.read(size).decode('ASCII')
+        return str(stream.read(size), 'ASCII')
@@ -0,0 +1,73 @@
+import io
+import pytest
+import ds_decima as decima
+
+text_type_hash = next(type_hash for type_hash, type_info in decima.pc_type_map.items()
+                      if type_info[1] is decima.LocalizedTextResource)
+
+
+@pytest.fixture
+def records(text_records):
+    return text_records(text_type_hash, len(decima.ETextLanguages), 3)
+
+
+def resize(record: bytes, size: int) -> bytes:
+    # Same record with its header size field rewritten
+    return decima.object_header_struct.pack(text_type_hash, size) + record[12:]
+
+
+def test_eager_round_trip(records):
+    for record in records:
+        text = decima.LocalizedTextResource(io.BytesIO(record))
+        assert len(text.language) == len(decima.ETextLanguages) == 25
+        assert decima.serialize_localized_text(text) == record
+
+
+def test_lazy_round_trip(records):
+    for record in records:
+        text = decima.LazyLocalizedTextResource(memoryview(record))
+        assert len(text.language) == 25
+        assert decima.serialize_localized_text(text) == record
+
+
+def test_core_round_trip(records):
+    # Every record parsed out of a whole core, eagerly and through the lazy index, serializes back to its own bytes
+    data = b''.join(records)
+    script_objects = {}
+    decima.read_objects_from_stream(decima.MappedStream(data), decima.pc_type_map, script_objects)
+    index = decima.ResourceIndex()
+    index.add_buffer(data)
+    for header, record in zip(decima.scan_headers(data), records):
+        assert decima.serialize_localized_text(script_objects[header.uuid]) == record
+        assert decima.serialize_localized_text(index.parse(header.uuid)) == record
+
+
+def test_edited_slot_round_trip(records):
+    text = decima.LocalizedTextResource(io.BytesIO(records[0]))
+    text.language[decima.ETextLanguages.English].text = 'Übersetzung ✓'
+    edited = decima.serialize_localized_text(text)
+    reparsed = decima.LocalizedTextResource(io.BytesIO(edited))
+    assert reparsed.language[decima.ETextLanguages.English].text == 'Übersetzung ✓'
+    assert reparsed.uuid == text.uuid
+    assert decima.serialize_localized_text(reparsed) == edited
+
+
+def test_truncated_record_raises(records):
+    record = records[1]
+    for cut in (len(record) - 1, len(record) - 4, 40):
+        with pytest.raises(Exception):
+            decima.LocalizedTextResource(io.BytesIO(record[:cut]))
+        with pytest.raises(Exception):
+            decima.LazyLocalizedTextResource(memoryview(resize(record[:cut], cut - 12)))
+
+
+def test_size_mismatch_raises(records):
+    # Header sizes that don't match the language slots are rejected rather than silently misread
+    record = records[1]
+    oversized = resize(record, len(record) - 12 + 5) + b'\0' * 5
+    with pytest.raises(Exception, match="didn't match size"):
+        decima.LocalizedTextResource(io.BytesIO(oversized))
+    with pytest.raises(Exception, match="didn't match size"):
+        decima.LazyLocalizedTextResource(memoryview(oversized))
+    with pytest.raises(Exception):
+        decima.LocalizedTextResource(io.BytesIO(resize(record, len(record) - 12 - 2)))
@@ -1,12 +1,20 @@
 import argparse
+import json
 import pydecima
 import struct
 import os
-from pathlib import PurePath
-from typing import Dict
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from pydecima.resources import PrefetchList
 
+object_header_struct = struct.Struct('<QI')
+count_struct = struct.Struct('<I')
+# Sizes and indices are packed as array('I'), which has to match the on-disk u32
+assert array('I').itemsize == 4
+
 
 class PrefetchPathInfo:
     def __init__(self, path_hash, size):
@@ -14,58 +22,236 @@ class PrefetchPathInfo:
         self.size = size
 
 
-def regenerate_prefetch(prefetch_file: str, output_file: str):
+def scan_stats(game_root: str, paths: Iterable[str], threads: int = 1) -> Dict[str, os.stat_result]:
+    # Maps each listed prefetch path to the stat of its .core under game_root. Only the directories that
+    # hold listed paths are scanned, each once, and every file is stat-ed at most once via its DirEntry.
+    wanted_by_dir: Dict[str, Dict[str, str]] = {}
+    for path in paths:
+        dir_name, _, file_name = path.rpartition('/')
+        wanted_by_dir.setdefault(dir_name, {})[file_name + '.core'] = path
+
+    def scan_dir(dir_name: str) -> List[Tuple[str, os.stat_result]]:
+        wanted = wanted_by_dir[dir_name]
+        found = []
+        try:
+            with os.scandir(os.path.join(game_root, dir_name)) as entries:
+                for entry in entries:
+                    path = wanted.get(entry.name)
+                    if path is not None and entry.is_file():
+                        found.append((path, entry.stat()))
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return found
+
+    stats: Dict[str, os.stat_result] = {}
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for found in executor.map(scan_dir, wanted_by_dir):
+                stats.update(found)
+    else:
+        for dir_name in wanted_by_dir:
+            stats.update(scan_dir(dir_name))
+    return stats
+
+
+def uint_array(values: Iterable[int]) -> array:
+    # Little-endian u32 array, ready to be copied into a record as-is
+    packed = array('I', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed
+
+
+def pack_uint_array_into(data: bytearray, pos: int, packed: array) -> int:
+    # Writes the count and then the array at pos, returning the position after it
+    count_struct.pack_into(data, pos, len(packed))
+    pos += count_struct.size
+    size = len(packed) * packed.itemsize
+    memoryview(data)[pos:pos + size] = memoryview(packed).cast('B')
+    return pos + size
+
+
+def serialize_prefetch(type_hash: int, uuid: bytes, prefetch_dict: Dict[str, PrefetchPathInfo],
+                       indices: Iterable[int]) -> bytearray:
+    # Builds the whole PrefetchList record in one preallocated buffer, so it can be written in a single call
+    paths = [(key.encode('ASCII'), info.path_hash) for key, info in prefetch_dict.items()]
+    sizes = uint_array(info.size for info in prefetch_dict.values())
+    indices = uint_array(indices)
+    paths_size = count_struct.size + sum(count_struct.size + len(path_hash) + len(path) for path, path_hash in paths)
+    arrays_size = 2 * count_struct.size + (len(sizes) + len(indices)) * sizes.itemsize
+    body_size = len(uuid) + paths_size + arrays_size
+    data = bytearray(object_header_struct.size + body_size)
+    object_header_struct.pack_into(data, 0, type_hash, body_size)
+    pos = object_header_struct.size
+    data[pos:pos + len(uuid)] = uuid
+    pos += len(uuid)
+    count_struct.pack_into(data, pos, len(paths))
+    pos += count_struct.size
+    for path, path_hash in paths:
+        count_struct.pack_into(data, pos, len(path))
+        pos += count_struct.size
+        # Empty paths are stored without a hash
+        data[pos:pos + len(path_hash)] = path_hash
+        pos += len(path_hash)
+        data[pos:pos + len(path)] = path
+        pos += len(path)
+    pos = pack_uint_array_into(data, pos, sizes)
+    pack_uint_array_into(data, pos, indices)
+    return data
+
+
+def prefetch_path(core_path: str, game_root: str) -> str:
+    # Absolute paths must be inside the game root; relative ones are taken as relative to it
+    if os.path.isabs(core_path):
+        root = os.path.abspath(game_root)
+        try:
+            inside = os.path.commonpath([root, os.path.abspath(core_path)]) == root
+        except ValueError:  # On a different drive
+            inside = False
+        if not inside:
+            raise ValueError('{} is not inside the game root {}'.format(core_path, root))
+        core_path = os.path.relpath(core_path, root)
+    core_path = os.path.normpath(core_path)
+    if core_path == os.pardir or core_path.startswith(os.pardir + os.sep):
+        raise ValueError('{} is not inside the game root'.format(core_path))
+    if core_path.endswith('.core'):
+        core_path = core_path[:-len('.core')]
+    return core_path.replace(os.sep, '/').replace('\\', '/')
+
+
+def read_changed(changed_file: str, game_root: str) -> List[str]:
+    # Either a text_repacker --repack-tree summary (only cores it actually repacked count), or one core path per line
+    if changed_file.endswith('.json'):
+        with open(changed_file, 'r', encoding='utf8') as in_file:
+            summary = json.load(in_file)
+        core_paths = [result['core'] for result in summary['files'] if result['status'] == 'repacked']
+    else:
+        with open(changed_file, 'r', encoding='utf8') as in_file:
+            core_paths = [line.strip() for line in in_file if line.strip()]
+    return [prefetch_path(core_path, game_root) for core_path in core_paths]
+
+
+def parse_newer_than(value: str) -> float:
+    # A Unix timestamp, or a reference file whose modification time is used
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return os.stat(value).st_mtime
+        except OSError:
+            raise argparse.ArgumentTypeError('not a timestamp or an existing file: {}'.format(value))
+
+
+def read_prefetch(prefetch_file: str) -> PrefetchList:
     script_objects = {}
     pydecima.reader.read_objects(prefetch_file, script_objects)
     assert (len(script_objects) == 1)
-    prefetch: PrefetchList = next(iter(script_objects.values()))
+    return next(iter(script_objects.values()))
+
+
+def validate_prefetch(prefetch_file: str, threads: int = 1) -> dict:
+    # Checks the prefetch against the game root in one pass over a single stat of every listed core
+    prefetch = read_prefetch(prefetch_file)
+    paths = [path.text for path in prefetch.paths]
+    stats = scan_stats(pydecima.reader.game_root, paths, threads)
+    missing = []
+    size_changed = []
+    duplicates = []
+    seen = set()
+    for path, size in zip(paths, prefetch.sizes):
+        if path in seen:
+            duplicates.append(path)
+            continue
+        seen.add(path)
+        stat = stats.get(path)
+        if stat is None:
+            missing.append(path)
+        elif stat.st_size != size:
+            size_changed.append({'path': path, 'prefetch_size': size, 'actual_size': stat.st_size})
+    bad_indices = [{'position': i, 'index': index} for i, index in enumerate(prefetch.indices) if index >= len(paths)]
+    return {
+        'prefetch': prefetch_file,
+        'valid': not (missing or size_changed or duplicates or bad_indices),
+        'paths': len(paths),
+        'sizes': len(prefetch.sizes),
+        'indices': len(prefetch.indices),
+        'missing': missing,
+        'size_changed': size_changed,
+        'duplicate_paths': duplicates,
+        'indices_out_of_range': bad_indices}
+
+
+def regenerate_prefetch(prefetch_file: str, output_file: str, threads: int = 1,
+                        changed: Optional[Iterable[str]] = None, newer_than: Optional[float] = None):
+    prefetch = read_prefetch(prefetch_file)
     # Note: In Python versions <3.6, order may be incorrect
     prefetch_dict: Dict[str, PrefetchPathInfo] = {path.text: PrefetchPathInfo(path.text_hash, prefetch.sizes[i])
                                                   for i, path in enumerate(prefetch.paths)}
 
-    for root, dirs, files in os.walk(pydecima.reader.game_root):
-        for file in files:
-            if not file.endswith('.core'):
-                continue
-            full_path = os.path.join(root, file)
-            relative_path = os.path.relpath(full_path, pydecima.reader.game_root)
-            path_without_ext = os.path.splitext(relative_path)[0]
-            final_path = PurePath(path_without_ext).as_posix()
-            if final_path in prefetch_dict:
-                if os.stat(full_path).st_size != prefetch_dict[final_path].size:
-                    print(f'{final_path} {prefetch_dict[final_path].size} -> {os.stat(full_path).st_size}')
-                    prefetch_dict[final_path].size = os.stat(full_path).st_size
-
-    # Write prefetch file
-    with open(output_file, 'w+b') as out:
-        out.write(struct.pack('<QI', prefetch.type_hash, 0))  # Placeholder length, need to update at end
-        out.write(prefetch.uuid)
-        out.write(struct.pack('<I', len(prefetch_dict)))
-        for key in prefetch_dict.keys():
-            out.write(struct.pack('<I', len(key)))
-            out.write(prefetch_dict[key].path_hash)
-            out.write(key.encode('ASCII'))
-        out.write(struct.pack('<I', len(prefetch_dict)))
-        for val in prefetch_dict.values():
-            out.write(struct.pack('<I', val.size))
-        out.write(struct.pack('<I', len(prefetch.indices)))
-        for index in prefetch.indices:
-            out.write(struct.pack('<I', index))
-        final_size = out.tell() - 12
-        out.seek(8)
-        out.write(struct.pack('<I', final_size))
+    game_root = pydecima.reader.game_root
+    if changed is not None:
+        # Only the changed cores are stat-ed, instead of every path in the prefetch
+        unknown = [path for path in changed if path not in prefetch_dict]
+        if unknown:
+            raise ValueError('Not in the prefetch: {}'.format(', '.join(unknown)))
+        paths = changed
+    else:
+        paths = prefetch_dict
+    stats = scan_stats(game_root, paths, threads)
+    if newer_than is not None:
+        stats = {path: stat for path, stat in stats.items() if stat.st_mtime > newer_than}
+
+    for final_path, stat in stats.items():
+        size = stat.st_size
+        if size != prefetch_dict[final_path].size:
+            print(f'{final_path} {prefetch_dict[final_path].size} -> {size}')
+            prefetch_dict[final_path].size = size
+
+    with open(output_file, 'wb') as out:
+        out.write(serialize_prefetch(prefetch.type_hash, prefetch.uuid, prefetch_dict, prefetch.indices))
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', type=str, required=True,
-                        help="Path to a prefetch file to update.")
-    parser.add_argument('-o', '--output', type=str, required=True,
+                        help="Path to a prefetch file to update or validate.")
+    parser.add_argument('-o', '--output', type=str,
                         help="Path for updated prefetch file to be written.")
+    parser.add_argument('-t', '--threads', type=int, default=8,
+                        help="Number of directories to scan concurrently (default 8; useful on network drives).")
+    parser.add_argument('-c', '--changed', type=str,
+                        help="Only update the cores listed in this file: one path per line (absolute and inside the "
+                             "game root, or relative to it), or a text_repacker --repack-tree JSON summary.")
+    parser.add_argument('-n', '--newer-than', type=parse_newer_than, metavar='TIMESTAMP_OR_FILE',
+                        help="Only update cores modified after this Unix timestamp, or after this file was.")
+    parser.add_argument('-v', '--validate', type=str, metavar='REPORT',
+                        help="Instead of updating, check the prefetch against the game files and write a JSON report "
+                             "to this path ('-' for stdout). Exits with status 1 if the prefetch is out of date or "
+                             "broken.")
     args = parser.parse_args()
+    if args.validate is None and args.output is None:
+        parser.error('one of -o/--output or -v/--validate is required')
     game_root_file = os.path.join(os.path.dirname(__file__), r'hzd_root_path.txt')
     pydecima.reader.set_globals(_game_root_file=game_root_file, _decima_version='HZDPC')
-    regenerate_prefetch(args.input, args.output)
+    if args.validate is not None:
+        report = validate_prefetch(args.input, args.threads)
+        if args.validate == '-':
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.validate, 'w', encoding='utf8') as report_file:
+                json.dump(report, report_file, indent=2)
+        print(f'{report["paths"]} paths: {len(report["missing"])} missing, {len(report["size_changed"])} with changed '
+              f'sizes, {len(report["duplicate_paths"])} duplicated, {len(report["indices_out_of_range"])} indices out '
+              f'of range.', file=sys.stderr if args.validate == '-' else sys.stdout)
+        if not report['valid']:
+            sys.exit(1)
+        return
+    try:
+        changed = read_changed(args.changed, pydecima.reader.game_root) if args.changed else None
+        regenerate_prefetch(args.input, args.output, args.threads, changed, args.newer_than)
+    except ValueError as e:
+        parser.error(str(e))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+import io
+import os
+import random
+import struct
+import zlib
+import pytest
+from typing import Dict, List
+from pydecima.enums import DecimaVersion
+from pydecima.resources import PrefetchList
+from regenerate_prefetch import PrefetchPathInfo, prefetch_path, serialize_prefetch
+
+prefetch_type_hash = 0xF34A76FAD0A1E0D7
+
+
+def legacy_serialize(type_hash: int, uuid: bytes, prefetch_dict: Dict[str, PrefetchPathInfo],
+                     indices: List[int]) -> bytes:
+    # The per-field writer serialize_prefetch replaced, kept as the reference output
+    out = io.BytesIO()
+    out.write(struct.pack('<QI', type_hash, 0))
+    out.write(uuid)
+    out.write(struct.pack('<I', len(prefetch_dict)))
+    for key in prefetch_dict.keys():
+        out.write(struct.pack('<I', len(key)))
+        out.write(prefetch_dict[key].path_hash)
+        out.write(key.encode('ASCII'))
+    out.write(struct.pack('<I', len(prefetch_dict)))
+    for val in prefetch_dict.values():
+        out.write(struct.pack('<I', val.size))
+    out.write(struct.pack('<I', len(indices)))
+    for index in indices:
+        out.write(struct.pack('<I', index))
+    final_size = out.tell() - 12
+    out.seek(8)
+    out.write(struct.pack('<I', final_size))
+    return out.getvalue()
+
+
+def make_prefetch(path_count: int, index_count: int, seed: int = 0):
+    rng = random.Random(seed)
+    prefetch_dict: Dict[str, PrefetchPathInfo] = {'': PrefetchPathInfo(b'', 0)}  # Empty paths carry no hash
+    for i in range(path_count):
+        path = 'models/dir{}/sub{}/file{}'.format(i % 7, i % 3, i)
+        prefetch_dict[path] = PrefetchPathInfo(struct.pack('<I', zlib.crc32(path.encode('ASCII'))),
+                                               rng.choice([0, 1, rng.randrange(1 << 32), (1 << 32) - 1]))
+    indices = [rng.randrange(len(prefetch_dict)) for _ in range(index_count)]
+    return rng.getrandbits(128).to_bytes(16, 'little'), prefetch_dict, indices
+
+
+def test_round_trip():
+    uuid, prefetch_dict, indices = make_prefetch(500, 2000)
+    data = serialize_prefetch(prefetch_type_hash, uuid, prefetch_dict, indices)
+    stream = io.BytesIO(bytes(data))
+    prefetch = PrefetchList(stream, DecimaVersion.HZDPC)
+    assert stream.tell() == len(data)
+    assert prefetch.type_hash == prefetch_type_hash
+    assert prefetch.uuid == uuid
+    assert [path.text for path in prefetch.paths] == list(prefetch_dict)
+    assert [path.text_hash for path in prefetch.paths] == [info.path_hash for info in prefetch_dict.values()]
+    assert prefetch.sizes == [info.size for info in prefetch_dict.values()]
+    assert prefetch.indices == indices
+
+
+def test_matches_legacy_writer():
+    for path_count, index_count in [(0, 0), (1, 0), (50, 3), (500, 2000)]:
+        uuid, prefetch_dict, indices = make_prefetch(path_count, index_count, seed=path_count)
+        assert serialize_prefetch(prefetch_type_hash, uuid, prefetch_dict, indices) == \
+            legacy_serialize(prefetch_type_hash, uuid, prefetch_dict, indices)
+
+
+def test_prefetch_path_normalised(tmp_path):
+    root = str(tmp_path)
+    for path in ['sub/t.core', './sub/t.core', 'sub/../sub/t.core', os.path.join(root, 'sub', '.', 't.core')]:
+        assert prefetch_path(path, root) == 'sub/t'
+    for path in ['../t.core', 'sub/../../t.core', os.path.join(os.path.dirname(root), 't.core')]:
+        with pytest.raises(ValueError, match='not inside the game root'):
+            prefetch_path(path, root)
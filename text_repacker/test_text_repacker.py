@@ -0,0 +1,45 @@
+import io
+import pydecima
+import pytest
+import text_repacker
+from pydecima.enums import ETextLanguages
+from pydecima.resources import LocalizedTextResource
+
+text_type_hash = 0xB89A596B420BB2E2
+
+
+@pytest.fixture(autouse=True)
+def decima_globals(tmp_path):
+    pydecima.reader.set_globals(_game_root=str(tmp_path), _decima_version='HZDPC')
+
+
+@pytest.fixture
+def records(text_records):
+    return text_records(text_type_hash, len(ETextLanguages), 0)
+
+
+def test_round_trip(records):
+    for record in records:
+        text = text_repacker.parse_text(record)
+        assert len(text.language) == len(ETextLanguages)
+        assert text_repacker.serialize_localized_text(text) == record
+
+
+def test_patch_text(records):
+    record = records[3]
+    patched = text_repacker.patch_text(record, 'Übersetzung ✓')
+    text = LocalizedTextResource(io.BytesIO(patched), pydecima.reader.decima_version)
+    original = text_repacker.parse_text(record)
+    assert text.language[text_repacker.language] == 'Übersetzung ✓'
+    assert text.uuid == original.uuid
+    assert [val for i, val in enumerate(text.language) if i != text_repacker.language] == \
+           [val for i, val in enumerate(original.language) if i != text_repacker.language]
+    assert text_repacker.serialize_localized_text(text) == patched
+
+
+def test_size_mismatch_raises(records):
+    # parse_text rejects records whose header size doesn't end where the last language slot does
+    record = records[1]
+    padded = text_repacker.object_header_struct.pack(text_type_hash, len(record) - 12 + 4) + record[12:] + b'\0' * 4
+    with pytest.raises(Exception, match="didn't match size"):
+        text_repacker.parse_text(padded)
@@ -1,84 +1,509 @@
 import io
 import os
+import sys
+import time
 import csv
+import mmap
+import bisect
+import shutil
+import tempfile
+import json
+import hashlib
+import functools
 import struct
 import pydecima
 import binascii
 import argparse
-from typing import Dict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Optional, List, Tuple, BinaryIO, NamedTuple, Sequence, Iterator, TextIO, Union
 from pydecima.enums import ETextLanguages
 from pydecima.resources import LocalizedTextResource
 from pydecima.type_maps import get_type_map
 
 simpletext_header = ['UUID', 'Text', 'Translation']
 language = ETextLanguages.English
+object_header_struct = struct.Struct('<QI')
+text_size_struct = struct.Struct('<H')
+# Compiled translation table: magic, version, SHA-256 of the CSV it was built from, entry count. Followed by the sorted
+# 16-byte UUIDs, an (offset, length) pair per UUID, and the UTF-8 text those point into.
+table_header_struct = struct.Struct('<4sI32sI')
+table_entry_struct = struct.Struct('<II')
+table_magic = b'TRTB'
+table_version = 2
 
 
-def dump_core(core_path: str, csv_path: str):
-    script_objects = {}
-    pydecima.reader.read_objects(core_path, script_objects)
-    with open(csv_path, 'w', newline='', encoding='utf8') as out_file:
+def dump_core(core_path: str, csv_path: str, extra_languages: Sequence[ETextLanguages] = (), dedup=False):
+    # Texts are parsed and written one at a time as the core is scanned. Each of extra_languages adds a reference
+    # column between Text and Translation. With dedup, rows with identical text columns are merged into one row whose
+    # UUID column lists every UUID sharing it, separated by spaces.
+    header = simpletext_header[:2] + ['Text ({})'.format(lang.name) for lang in extra_languages] + \
+        simpletext_header[2:]
+    with open(core_path, 'rb') as core_file, open(csv_path, 'w', newline='', encoding='utf8') as out_file:
+        orig_core = map_core(core_file)
         out = csv.writer(out_file, quoting=csv.QUOTE_ALL)
-        out.writerow(simpletext_header)
-        for obj in script_objects.values():
-            if isinstance(obj, LocalizedTextResource):
-                out.writerow([binascii.hexlify(obj.uuid).decode('ASCII'), obj.language[language], ''])
+        out.writerow(header)
+        groups: Dict[Tuple[str, ...], List[str]] = {}
+        for start, end, obj_uuid in scan_texts(orig_core):
+            text = parse_text(orig_core[start:end].tobytes())
+            uuid = binascii.hexlify(obj_uuid).decode('ASCII')
+            texts = (text.language[language],) + tuple(text.language[lang] for lang in extra_languages)
+            if dedup:
+                groups.setdefault(texts, []).append(uuid)
+            else:
+                out.writerow([uuid, *texts, ''])
+        for texts, uuids in groups.items():
+            out.writerow([' '.join(uuids), *texts, ''])
+
 
+@functools.lru_cache()
+def get_int_type_map(version) -> Dict[int, str]:
+    # pydecima keys type maps by hex string; keying by the integer hash avoids formatting a string per object header
+    return {int(type_hash, 16): type_name for type_hash, type_name in get_type_map(version).items()}
 
-def serialize_localized_text(text: LocalizedTextResource):
-    output = text.uuid
 
+def serialize_localized_text(text: LocalizedTextResource) -> bytearray:
+    out = bytearray(object_header_struct.size)
+    out += text.uuid
+    pack_size = text_size_struct.pack
     for lang in text.language:
         val = lang.encode('utf8')
-        output += struct.pack('<H', len(val))
-        output += val
+        out += pack_size(len(val))
+        out += val
+    object_header_struct.pack_into(out, 0, text.type_hash, len(out) - object_header_struct.size)
+    return out
 
-    output = struct.pack('<QI', text.type_hash, len(output)) + output
-    return output
 
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_path(core_path: str) -> str:
+    return core_path + '.manifest'
+
+
+# A CSV saved again within the same mtime tick (2 seconds on FAT and SMB) can keep its old mtime, so one modified less
+# than this long before its manifest was written is hashed rather than trusted by size and mtime
+mtime_granularity_ns = 2 * 10 ** 9
+
+
+def read_manifest(core_path: str) -> Optional[dict]:
+    try:
+        with open(manifest_path(core_path), 'r', encoding='utf8') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def matches_manifest(path: str, manifest: dict, prefix: str, trust_mtime=True) -> bool:
+    # Size and mtime first; the file is only hashed when its mtime moved (or can't be trusted) but its size didn't
+    stat = os.stat(path)
+    if stat.st_size != manifest.get(prefix + '_size'):
+        return False
+    if trust_mtime and stat.st_mtime_ns == manifest.get(prefix + '_mtime_ns'):
+        return True
+    return manifest.get(prefix + '_sha256') is not None and file_digest(path) == manifest[prefix + '_sha256']
 
-def repack_core(core_path: str, csv_path: str):
-    text_map: Dict[bytes, str] = dict()
 
+def is_up_to_date(core_path: str, csv_path: str) -> bool:
+    # A core is up to date if it is still the output of the last repack, made with the same CSV file. Neither file is
+    # read unless its size or mtime changed.
+    manifest = read_manifest(core_path)
+    if manifest is None:
+        return False
+    csv_mtime_trusted = manifest.get('csv_mtime_ns', 0) <= manifest.get('written_ns', 0) - mtime_granularity_ns
+    if not (matches_manifest(core_path, manifest, 'core') and
+            matches_manifest(csv_path, manifest, 'csv', csv_mtime_trusted)):
+        return False
+    core_mtime_ns = os.stat(core_path).st_mtime_ns
+    csv_mtime_ns = os.stat(csv_path).st_mtime_ns
+    if not csv_mtime_trusted or (core_mtime_ns, csv_mtime_ns) != (manifest['core_mtime_ns'], manifest['csv_mtime_ns']):
+        # Something had to be hashed and turned out unchanged; record the current mtimes so the next check doesn't
+        manifest.update(core_mtime_ns=core_mtime_ns, csv_mtime_ns=csv_mtime_ns, written_ns=time.time_ns())
+        save_manifest(core_path, manifest)
+    return True
+
+
+def write_manifest(core_path: str, csv_path: str, translations_digest: str, hash_core=True):
+    # Without hash_core, the core can only be matched by size and mtime later, so touching it forces a repack
+    core_stat = os.stat(core_path)
+    csv_stat = os.stat(csv_path)
+    save_manifest(core_path, {
+        'core_size': core_stat.st_size,
+        'core_mtime_ns': core_stat.st_mtime_ns,
+        'core_sha256': file_digest(core_path) if hash_core else None,
+        'csv_size': csv_stat.st_size,
+        'csv_mtime_ns': csv_stat.st_mtime_ns,
+        'csv_sha256': translations_digest,
+        'written_ns': time.time_ns()})
+
+
+def save_manifest(core_path: str, manifest: dict):
+    with open(manifest_path(core_path), 'w', encoding='utf8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def read_translations(csv_path: str) -> Dict[bytes, str]:
     with open(csv_path, 'r', newline='', encoding='utf8') as csv_file:
-        reader = iter(csv.reader(csv_file, quoting=csv.QUOTE_ALL))
-        header = next(reader)
-        assert(header == simpletext_header)
-        for line in reader:
-            if len(line[-1]) > 0:
-                obj_hash = binascii.unhexlify(line[0])
-                new_text = line[-1]
-                text_map[obj_hash] = new_text
+        return parse_translations(csv_file)
+
+
+def parse_translations(csv_file: TextIO) -> Dict[bytes, str]:
+    text_map: Dict[bytes, str] = dict()
+    reader = iter(csv.reader(csv_file, quoting=csv.QUOTE_ALL))
+    header = next(reader)
+    assert(header[:2] == simpletext_header[:2] and header[-1] == simpletext_header[-1])
+    for line in reader:
+        if len(line[-1]) > 0:
+            new_text = line[-1]
+            # Deduplicated rows fan out to every UUID they list
+            for uuid in line[0].split():
+                text_map[binascii.unhexlify(uuid)] = new_text
+    return text_map
+
+
+def table_path(csv_path: str) -> str:
+    return csv_path + '.table'
+
+
+def read_translations_digest(csv_path: str) -> Tuple[str, Dict[bytes, str]]:
+    # SHA-256 of the CSV and its translations, both from the same read of the file
+    with open(csv_path, 'rb') as csv_file:
+        data = csv_file.read()
+    return hashlib.sha256(data).hexdigest(), parse_translations(io.StringIO(data.decode('utf8'), newline=''))
+
+
+def compile_translations(csv_path: str):
+    write_table(csv_path, *read_translations_digest(csv_path))
+
+
+def write_table(csv_path: str, translations_digest: str, text_map: Dict[bytes, str]):
+    uuids = sorted(text_map)
+    entries = bytearray()
+    blob = bytearray()
+    for uuid in uuids:
+        val = text_map[uuid].encode('utf8')
+        entries += table_entry_struct.pack(len(blob), len(val))
+        blob += val
+
+    out_path = table_path(csv_path)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out_file:
+            out_file.write(table_header_struct.pack(table_magic, table_version, bytes.fromhex(translations_digest),
+                                                    len(uuids)))
+            out_file.write(b''.join(uuids))
+            out_file.write(entries)
+            out_file.write(blob)
+        os.replace(temp_path, out_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class InMemoryTranslations(dict):
+    # Stands in for a TranslationTable when the compiled table can't be written beside the CSV
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+
+class TranslationTable:
+    # Read-only UUID -> translation lookup over a memory-mapped compiled table, using binary search on the UUIDs
+    class Uuids:
+        def __init__(self, view: memoryview, count: int):
+            self.view = view
+            self.count = count
+
+        def __getitem__(self, index: int) -> bytes:
+            start = table_header_struct.size + index * 16
+            return bytes(self.view[start:start + 16])
+
+        def __len__(self):
+            return self.count
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as table_file:
+            self.map = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, version, csv_sha256, count = table_header_struct.unpack_from(self.view)
+        self.csv_sha256: str = csv_sha256.hex()
+        if magic != table_magic or version != table_version:
+            self.close()
+            raise ValueError('{} is not a compiled translation table'.format(path))
+        self.uuids = TranslationTable.Uuids(self.view, count)
+        self.entries_start = table_header_struct.size + count * 16
+        self.blob_start = self.entries_start + count * table_entry_struct.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.view.release()
+        self.map.close()
 
+    def find(self, uuid: bytes) -> int:
+        index = bisect.bisect_left(self.uuids, uuid)
+        return index if index < len(self.uuids) and self.uuids[index] == uuid else -1
+
+    def __contains__(self, uuid: bytes):
+        return self.find(uuid) >= 0
+
+    def __getitem__(self, uuid: bytes) -> str:
+        index = self.find(uuid)
+        if index < 0:
+            raise KeyError(uuid)
+        offset, size = table_entry_struct.unpack_from(self.view, self.entries_start + index * table_entry_struct.size)
+        start = self.blob_start + offset
+        return str(self.view[start:start + size], 'utf8')
+
+    def __len__(self):
+        return len(self.uuids)
+
+
+def load_translations(csv_path: str, translations_digest: Optional[str] = None) \
+        -> Union[TranslationTable, InMemoryTranslations]:
+    # Uses the compiled table beside the CSV, (re)building it first if it wasn't compiled from a CSV with this SHA-256.
+    # Compared by content rather than size and mtime, which can stay the same across an edit (coarse timestamps on
+    # FAT/SMB, copies that preserve them).
+    if translations_digest is None:
+        translations_digest = file_digest(csv_path)
+    try:
+        table = TranslationTable(table_path(csv_path))
+        if table.csv_sha256 == translations_digest:
+            return table
+        table.close()
+    except (OSError, ValueError, struct.error):
+        pass
+    digest, text_map = read_translations_digest(csv_path)
+    if digest != translations_digest:
+        raise Exception('{} changed while it was being read'.format(csv_path))
+    try:
+        write_table(csv_path, digest, text_map)
+    except OSError:
+        # e.g. the CSV's folder is read-only; use the parsed translations directly this time
+        return InMemoryTranslations(text_map)
+    return TranslationTable(table_path(csv_path))
+
+
+class RepackStats(NamedTuple):
+    texts: int
+    bytes_written: int
+
+
+def repack_core(core_path: str, csv_path: str, force=False, in_place=False) -> Optional[RepackStats]:
+    # Returns None if the core was skipped because it is already up to date
+    if not force and is_up_to_date(core_path, csv_path):
+        return None
+    translations_digest = file_digest(csv_path)
+
+    with load_translations(csv_path, translations_digest) as text_map:
+        patches = build_patches(core_path, text_map)
+    patched_in_place = in_place and all(len(data) == end - start for start, end, data in patches)
+    if patched_in_place:
+        bytes_written = patch_in_place(core_path, patches)
+    else:
+        # Write to a temporary file next to the core and swap it in at the end, so a failed repack leaves the original
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(core_path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                write_repacked_core(core_path, out_file, patches)
+                bytes_written = out_file.tell()
+            shutil.copymode(core_path, temp_path)
+            os.replace(temp_path, core_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    # Hashing the patched core would read all of it again, so in-place repacks only record its size and mtime
+    write_manifest(core_path, csv_path, translations_digest, hash_core=not patched_in_place)
+    return RepackStats(len(patches), bytes_written)
+
+
+def map_core(core_file: BinaryIO) -> memoryview:
+    if os.fstat(core_file.fileno()).st_size == 0:
+        return memoryview(b'')
+    return memoryview(mmap.mmap(core_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def scan_texts(core: memoryview) -> Iterator[Tuple[int, int, bytes]]:
+    # Header-only scan yielding (start, end, uuid) of every LocalizedTextResource, with one type map resolution
+    type_map = get_int_type_map(pydecima.reader.decima_version)
+    text_types = {type_hash for type_hash, type_name in type_map.items() if type_name == 'LocalizedTextResource'}
+    pos = 0
+    while pos < len(core):
+        if pos + 28 > len(core):
+            raise Exception('Truncated object header at offset {}'.format(pos))
+        obj_type, obj_size = object_header_struct.unpack_from(core, pos)
+        end = pos + 12 + obj_size
+        if end > len(core):
+            raise Exception('Object at offset {} runs past end of file'.format(pos))
+        if obj_type in text_types:
+            yield pos, end, bytes(core[pos + 12:pos + 28])
+        pos = end
+
+
+def plan_repack(core: memoryview, text_map: TranslationTable) -> List[Tuple[int, int, bytes]]:
+    # (start, end, uuid) of every text that has a translation
+    return [(start, end, obj_uuid) for start, end, obj_uuid in scan_texts(core) if obj_uuid in text_map]
+
+
+def parse_text(record: bytes) -> LocalizedTextResource:
+    stream = io.BytesIO(record)
+    text = LocalizedTextResource(stream, pydecima.reader.decima_version)
+    if stream.tell() != len(record):
+        raise Exception("{} didn't match size, expected {}, read {}"
+                        .format(binascii.hexlify(text.uuid).decode('ASCII'), len(record), stream.tell()))
+    return text
+
+
+def patch_text(record: bytes, new_text: str) -> bytearray:
+    text = parse_text(record)
+    text.language[language] = new_text
+    return serialize_localized_text(text)
+
+
+def build_patches(core_path: str, text_map: TranslationTable) -> List[Tuple[int, int, bytearray]]:
+    # (start, end, new record) for every translated text, in file order
+    with open(core_path, 'rb') as core_file:
+        orig_core = map_core(core_file)
+        return [(start, end, patch_text(orig_core[start:end].tobytes(), text_map[obj_uuid]))
+                for start, end, obj_uuid in plan_repack(orig_core, text_map)]
+
+
+def write_repacked_core(core_path: str, out_file: BinaryIO, patches: List[Tuple[int, int, bytearray]]):
+    with open(core_path, 'rb') as core_file:
+        orig_core = map_core(core_file)
+        copy_start = 0
+        for start, end, data in patches:
+            # Unchanged objects between patched texts are copied as a single range
+            out_file.write(orig_core[copy_start:start])
+            out_file.write(data)
+            copy_start = end
+        out_file.write(orig_core[copy_start:])
+
+
+def patch_in_place(core_path: str, patches: List[Tuple[int, int, bytearray]]) -> int:
+    # Only valid when every patch is exactly the size of the record it replaces; only records that differ are written.
+    # Returns the number of bytes written.
+    bytes_written = 0
     with open(core_path, 'r+b') as core_file:
-        orig_core = io.BytesIO(core_file.read())
-        core_file.seek(0)
-        core_file.truncate(0)
-        while True:
-            start = orig_core.tell()
-            obj_type = orig_core.read(8)
-            if len(obj_type) < 8:
-                break
-            str_type = '{0:X}'.format(struct.unpack('<Q', obj_type)[0])
-            obj_size = struct.unpack('<I', orig_core.read(4))[0]
-            obj_uuid = orig_core.read(16)
-            orig_core.read(obj_size)
-
-            type_map = get_type_map(pydecima.reader.decima_version)
-            if type_map[str_type] == 'LocalizedTextResource' and obj_uuid in text_map:
-                script_objects = {}
-                orig_core.seek(start)
-                resource_stream = io.BytesIO(orig_core.read(obj_size + 12))
-                pydecima.reader.read_objects_from_stream(resource_stream, script_objects)
-                assert(len(script_objects) == 1)
-                text = script_objects[obj_uuid]
-                text.language[language] = text_map[obj_uuid]
-                serialized_text = serialize_localized_text(text)
-                core_file.write(serialized_text)
+        fd = core_file.fileno()
+        for start, end, data in patches:
+            if hasattr(os, 'pread') and os.pread(fd, end - start, start) == data:
+                continue
+            if hasattr(os, 'pwrite'):
+                written = 0
+                while written < len(data):
+                    written += os.pwrite(fd, memoryview(data)[written:], start + written)
+            else:
+                core_file.seek(start)
+                core_file.write(data)
+            bytes_written += len(data)
+    return bytes_written
+
+
+def find_core_pairs(root: str) -> List[Tuple[str, str]]:
+    pairs = []
+    for dir_path, _, file_names in os.walk(root):
+        names = set(file_names)
+        for file_name in file_names:
+            stem, ext = os.path.splitext(file_name)
+            if ext == '.core' and stem + '.csv' in names:
+                pairs.append((os.path.join(dir_path, file_name), os.path.join(dir_path, stem + '.csv')))
+    pairs.sort()
+    return pairs
+
+
+def read_pair_list(pairs_file: str) -> List[Tuple[str, str]]:
+    # CSV rows of core path and (optionally) CSV path, relative to the pair list's folder. Without a CSV path, the CSV
+    # beside the core is used.
+    base_dir = os.path.dirname(os.path.abspath(pairs_file))
+    pairs = []
+    with open(pairs_file, 'r', newline='', encoding='utf8') as in_file:
+        for line in csv.reader(in_file):
+            if not line or not line[0].strip() or line[0].startswith('#'):
+                continue
+            core_path = os.path.join(base_dir, line[0].strip())
+            csv_path = os.path.join(base_dir, line[1].strip()) if len(line) > 1 and line[1].strip() \
+                else os.path.splitext(core_path)[0] + '.csv'
+            pairs.append((core_path, csv_path))
+    return pairs
+
+
+def init_worker(game_root_file: str, decima_version: str):
+    # Runs once per worker process, so pydecima stays set up for every core that worker repacks
+    pydecima.reader.set_globals(_game_root_file=game_root_file, _decima_version=decima_version)
+
+
+def repack_timed(core_path: str, csv_path: str, force: bool, in_place: bool) -> Tuple[Optional[RepackStats], float]:
+    start = time.perf_counter()
+    stats = repack_core(core_path, csv_path, force, in_place)
+    return stats, time.perf_counter() - start
+
+
+def repack_tree(pairs: List[Tuple[str, str]], game_root_file: str, summary_path: str, jobs: Optional[int] = None,
+                force=False, in_place=False) -> List[str]:
+    results = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(game_root_file, pydecima.reader.decima_version.value)) as executor:
+        futures = {executor.submit(repack_timed, core_path, csv_path, force, in_place): (core_path, csv_path)
+                   for core_path, csv_path in pairs}
+        for i, future in enumerate(as_completed(futures), 1):
+            core_path, csv_path = futures[future]
+            # Absolute, so the summary can be read from any working directory (e.g. by regenerate_prefetch --changed)
+            result = {'core': os.path.abspath(core_path), 'csv': os.path.abspath(csv_path)}
+            try:
+                stats, seconds = future.result()
+            except Exception as e:
+                failed.append(core_path)
+                result.update(status='failed', error=str(e))
+                print(f'[{i}/{len(pairs)}] {core_path}: failed: {e}')
             else:
-                # Copy data without modifying
-                orig_core.seek(start)
-                core_file.write(orig_core.read(obj_size + 12))
+                result['seconds'] = round(seconds, 4)
+                if stats is None:
+                    result['status'] = 'skipped'
+                    print(f'[{i}/{len(pairs)}] {core_path}: up to date, skipped')
+                else:
+                    result.update(status='repacked', texts=stats.texts, bytes_written=stats.bytes_written)
+                    print(f'[{i}/{len(pairs)}] {core_path}: {stats.texts} texts repacked')
+            results.append(result)
+
+    results.sort(key=lambda r: r['core'])
+    repacked = [r for r in results if r['status'] == 'repacked']
+    summary = {
+        'cores': len(results),
+        'repacked': len(repacked),
+        'skipped': sum(1 for r in results if r['status'] == 'skipped'),
+        'failed': len(failed),
+        'texts': sum(r['texts'] for r in repacked),
+        'bytes_written': sum(r['bytes_written'] for r in repacked),
+        'seconds': round(sum(r.get('seconds', 0) for r in results), 4),
+        'files': results}
+    with open(summary_path, 'w', encoding='utf8') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print(f'{summary["repacked"]} of {summary["cores"]} cores repacked ({summary["skipped"]} up to date, '
+          f'{summary["failed"]} failed), {summary["texts"]} texts in total. Summary written to {summary_path}.')
+    return failed
+
+
+def parse_language(name: str) -> ETextLanguages:
+    try:
+        return next(lang for lang in ETextLanguages if lang.name.casefold() == name.casefold())
+    except StopIteration:
+        raise argparse.ArgumentTypeError('unknown language: {} (expected one of {})'.format(
+            name, ', '.join(lang.name for lang in ETextLanguages)))
 
 
 def main():
@@ -88,6 +513,22 @@ def main():
                        help="Path to a core file to dump.")
     group.add_argument('-r', '--repack', type=str,
                        help="Path to a core file to repack.")
+    group.add_argument('-t', '--repack-tree', type=str,
+                       help="Path to a directory, in which every core with a CSV file beside it will be repacked, or "
+                            "to a pair list file of core and CSV paths (one pair per line).")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Number of worker processes for --repack-tree (defaults to the CPU count).")
+    parser.add_argument('-s', '--summary', type=str, default='repack_summary.json',
+                        help="Where --repack-tree writes its JSON summary.")
+    parser.add_argument('-l', '--languages', type=parse_language, nargs='+', default=[],
+                        help="Extra languages to dump as reference columns beside the English text.")
+    parser.add_argument('--dedup', action='store_true',
+                        help="Dump each distinct text once, with all the UUIDs that share it in its UUID column.")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Repack even if the core and its CSV file are unchanged since the last repack.")
+    parser.add_argument('-i', '--in-place', action='store_true',
+                        help="If every translated text keeps its exact size in bytes, overwrite only those texts in "
+                             "the core instead of rewriting the whole file.")
     args = parser.parse_args()
 
     game_root_file = os.path.join(os.path.dirname(__file__), r'hzd_root_path.txt')
@@ -96,13 +537,23 @@ def main():
     if args.dump:
         csv_path = os.path.splitext(args.dump)[0] + '.csv'
         assert os.path.isfile(args.dump)
-        dump_core(args.dump, csv_path)
+        dump_core(args.dump, csv_path, args.languages, args.dedup)
         print('CSV file generated.')
     elif args.repack:
         csv_path = os.path.splitext(args.repack)[0] + '.csv'
         assert os.path.isfile(args.repack)
-        repack_core(args.repack, csv_path)
-        print('Updated text repacked into core.')
+        if repack_core(args.repack, csv_path, args.force, args.in_place) is None:
+            print('Core is already up to date with its CSV file, skipping (use --force to repack anyway).')
+        else:
+            print('Updated text repacked into core.')
+    elif args.repack_tree:
+        if os.path.isdir(args.repack_tree):
+            pairs = find_core_pairs(args.repack_tree)
+        else:
+            assert os.path.isfile(args.repack_tree)
+            pairs = read_pair_list(args.repack_tree)
+        if repack_tree(pairs, game_root_file, args.summary, args.jobs, args.force, args.in_place):
+            sys.exit(1)
 
 
 if __name__ == '__main__':